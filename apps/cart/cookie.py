@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core import signing
+from goods.utils import parse_sku_id
+from collections import OrderedDict
+import base64
+import struct
+import json
+import zlib
+
+
+# 未登录用户的购物车cookie
+CART_COOKIE = 'cart'
+# 签名的salt : 和其他使用SECRET_KEY签名的数据区分开
+CART_COOKIE_SALT = 'cart.cookie'
+
+# cookie格式 : 签名(<版本>.<base64>)
+# 版本2 : base64的内容是 1个字节的标记(0 原始, 1 zlib压缩) + 每个商品两个无符号32位整数 (sku_id, count)
+# 之前的版本是没有签名的json字符串 {"sku_id": count, ...},读取后在响应中改写成新格式
+CART_COOKIE_VERSION = '2'
+_FLAG_RAW = b'\x00'
+_FLAG_ZLIB = b'\x01'
+_MAX_INT = 0xFFFFFFFF
+
+
+def _clean_items(pairs):
+    """只保留合法的商品 : sku_id和count都是正整数,最多CART_COOKIE_MAX_ITEMS个"""
+    items = OrderedDict()
+    for sku_id, count in pairs:
+        sku_id = parse_sku_id(sku_id)
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            continue
+        if sku_id is None or not 0 < sku_id <= _MAX_INT or not 0 < count <= _MAX_INT:
+            continue
+        items[sku_id] = count
+        if len(items) >= settings.CART_COOKIE_MAX_ITEMS:
+            break
+    return items
+
+
+def encode_cart(items):
+    """{sku_id: count} -> cookie的值"""
+    data = b''.join(struct.pack('>II', sku_id, count) for sku_id, count in items.items())
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data):
+        data = _FLAG_ZLIB + compressed
+    else:
+        data = _FLAG_RAW + data
+    payload = base64.urlsafe_b64encode(data).decode().rstrip('=')
+    return signing.Signer(salt=CART_COOKIE_SALT).sign('%s.%s' % (CART_COOKIE_VERSION, payload))
+
+
+def decode_cart(value):
+    """cookie的值 -> (items, legacy),签名错误或者格式错误时返回空购物车
+
+    legacy为True时说明是之前的json格式,需要改写成新格式
+    """
+    try:
+        version, payload = signing.Signer(salt=CART_COOKIE_SALT).unsign(value).split('.', 1)
+    except signing.BadSignature:
+        return _decode_legacy(value), True
+    except ValueError:
+        return OrderedDict(), True
+
+    if version != CART_COOKIE_VERSION:
+        return OrderedDict(), True
+
+    try:
+        data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+        flag, data = data[:1], data[1:]
+        if flag == _FLAG_ZLIB:
+            data = zlib.decompress(data)
+        pairs = [struct.unpack_from('>II', data, i) for i in range(0, len(data) - 7, 8)]
+    except (ValueError, TypeError, zlib.error, struct.error):
+        return OrderedDict(), True
+    return _clean_items(pairs), False
+
+
+def _decode_legacy(value):
+    """之前的json格式 : 没有签名,只保留合法的商品"""
+    try:
+        cart_dict = json.loads(value)
+    except ValueError:
+        return OrderedDict()
+    if not isinstance(cart_dict, dict):
+        return OrderedDict()
+    return _clean_items(cart_dict.items())
+
+
+class CookieCart(object):
+    """未登录用户的购物车 : 每个请求由CartCookieMiddleware解析一次,修改之后在响应中写入cookie
+
+    说明 : sku_id和count都是int
+    """
+
+    def __init__(self, items=None, modified=False):
+        self.items = OrderedDict() if items is None else items
+        self.modified = modified
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.COOKIES.get(CART_COOKIE)
+        if value is None:
+            return cls()
+        items, legacy = decode_cart(value)
+        return cls(items, modified=legacy)
+
+    def get_total(self):
+        """购物车中的商品总数量"""
+        return sum(self.items.values())
+
+    def get_all(self):
+        """购物车中所有的商品 : {sku_id: count}"""
+        return dict(self.items)
+
+    def get(self, sku_id):
+        """商品的数量,不在购物车中时返回0"""
+        return self.items.get(parse_sku_id(sku_id), 0)
+
+    def set(self, sku_id, count, stock=None):
+        """修改商品数量 : 数量不是正数时删除商品,超过库存时改成库存
+
+        说明 : cookie中的数量是无符号32位整数,写入不合法的数量会在响应时出错
+        """
+        sku_id = parse_sku_id(sku_id)
+        if sku_id is None:
+            return
+        count = min(count, _MAX_INT if stock is None else stock)
+        if count <= 0:
+            self.delete(sku_id)
+            return
+        self.items[sku_id] = count
+        self.modified = True
+
+    def delete(self, sku_id):
+        """删除商品"""
+        if self.items.pop(parse_sku_id(sku_id), None) is not None:
+            self.modified = True
+
+    def clear(self):
+        """清空购物车 : 登录后合并到redis时使用"""
+        if self.items:
+            self.items.clear()
+        self.modified = True
+
+    def update_response(self, response):
+        """购物车修改过时写入cookie,清空时删除cookie"""
+        if not self.modified:
+            return
+        if self.items:
+            response.set_cookie(CART_COOKIE, encode_cart(self.items),
+                                max_age=settings.CART_COOKIE_MAX_AGE, httponly=True)
+        else:
+            response.delete_cookie(CART_COOKIE)
+
+
+class CartCookieMiddleware(object):
+    """每个请求只解析一次购物车cookie : request.cookie_cart"""
+
+    def process_request(self, request):
+        request.cookie_cart = CookieCart.from_request(request)
+
+    def process_response(self, request, response):
+        cart = getattr(request, 'cookie_cart', None)
+        if cart is not None:
+            cart.update_response(response)
+        return response
@@ -0,0 +1,140 @@
+from utils.redis_store import RedisRepository
+
+
+# 登录用户的购物车 : cart_<user_id> = {sku_id: count, ...}
+CART_KEY = 'cart_%s'
+# 购物车中的商品总数量 : cart_total_<user_id> = 所有count之和,和购物车在同一个脚本中修改
+CART_TOTAL_KEY = 'cart_total_%s'
+
+
+# 读取总数量 : 总数量不存在时(修改之前的历史数据/被删除),用购物车重新计算并保存
+# 每个脚本在修改购物车之前调用,保证总数量和修改之前的购物车一致
+TOTAL_FUNCTION = """
+local function get_total()
+    local total = redis.call('get', KEYS[2])
+    if total then
+        return tonumber(total)
+    end
+    local sum = 0
+    for i, count in ipairs(redis.call('hvals', KEYS[1])) do
+        sum = sum + tonumber(count)
+    end
+    redis.call('set', KEYS[2], sum)
+    return sum
+end
+"""
+
+# KEYS = [cart_<user_id>, cart_total_<user_id>]
+TOTAL_SCRIPT = TOTAL_FUNCTION + """
+return get_total()
+"""
+
+# 添加商品(累加) : ARGV = [sku_id, count, stock]
+# 返回值 : {累加后的数量, 总数量},  累加后超出库存时不修改,返回 {-1, 总数量}
+ADD_SCRIPT = TOTAL_FUNCTION + """
+local total = get_total()
+local count = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0) + tonumber(ARGV[2])
+if count > tonumber(ARGV[3]) then
+    return {-1, total}
+end
+redis.call('hset', KEYS[1], ARGV[1], count)
+return {count, redis.call('incrby', KEYS[2], ARGV[2])}
+"""
+
+# 修改商品数量(幂等) : ARGV = [sku_id, count]  返回值 : 总数量
+SET_SCRIPT = TOTAL_FUNCTION + """
+get_total()
+local origin = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0)
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+return redis.call('incrby', KEYS[2], tonumber(ARGV[2]) - origin)
+"""
+
+# 删除商品 : ARGV = [sku_id, ...]  返回值 : 总数量
+DELETE_SCRIPT = TOTAL_FUNCTION + """
+get_total()
+local delta = 0
+for i, sku_id in ipairs(ARGV) do
+    local origin = redis.call('hget', KEYS[1], sku_id)
+    if origin then
+        redis.call('hdel', KEYS[1], sku_id)
+        delta = delta + tonumber(origin)
+    end
+end
+return redis.call('decrby', KEYS[2], delta)
+"""
+
+# 合并商品(累加) : ARGV = [sku_id1, count1, stock1, sku_id2, count2, stock2, ...]  返回值 : 总数量
+# 累加之后的数量不超过库存 : 每个商品一次HINCRBY,只增加库存允许的部分,已经超过库存的不减少
+MERGE_SCRIPT = TOTAL_FUNCTION + """
+get_total()
+local delta = 0
+for i = 1, #ARGV, 3 do
+    local origin = tonumber(redis.call('hget', KEYS[1], ARGV[i]) or 0)
+    local count = math.min(origin + tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2]))
+    if count > origin then
+        redis.call('hincrby', KEYS[1], ARGV[i], count - origin)
+        delta = delta + count - origin
+    end
+end
+return redis.call('incrby', KEYS[2], delta)
+"""
+
+
+class RedisCart(RedisRepository):
+    """登录用户的购物车 : 每次修改都是一次lua脚本调用,同时维护总数量,读取购物车数量不需要遍历购物车
+
+    说明 : 所有修改cart_<user_id>的地方都需要通过这个类,否则总数量会和购物车不一致
+    """
+
+    def __init__(self, user_id, redis_conn=None):
+        super().__init__(redis_conn)
+        self.keys = [CART_KEY % user_id, CART_TOTAL_KEY % user_id]
+
+    def _run(self, script, args=()):
+        return self.run_script(script, self.keys, args)
+
+    def get_total(self):
+        """购物车中的商品总数量 : 一次GET"""
+        total = self.redis_conn.get(self.keys[1])
+        if total is None:
+            total = self._run(TOTAL_SCRIPT)
+        return int(total)
+
+    def get_all(self):
+        """购物车中所有的商品 : {sku_id(bytes): count(bytes)}"""
+        return self.redis_conn.hgetall(self.keys[0])
+
+    def get_counts(self, sku_ids):
+        """读取商品的数量 : 返回的列表和sku_ids一一对应,不在购物车中的是None"""
+        return self.redis_conn.hmget(self.keys[0], *sku_ids)
+
+    def add(self, sku_id, count, stock):
+        """添加商品,和购物车中已有的数量累加 : 返回 (累加后的数量, 总数量),超出库存时累加后的数量为None"""
+        count, total = self._run(ADD_SCRIPT, [sku_id, count, stock])
+        if count < 0:
+            count = None
+        return count, total
+
+    def set(self, sku_id, count):
+        """修改商品数量 : 返回总数量"""
+        return self._run(SET_SCRIPT, [sku_id, count])
+
+    def delete(self, *sku_ids):
+        """删除商品 : 返回总数量"""
+        if not sku_ids:
+            return self.get_total()
+        return self._run(DELETE_SCRIPT, sku_ids)
+
+    def merge(self, cart_dict, stocks):
+        """合并商品,和购物车中已有的数量累加,累加之后不超过库存 : 返回总数量
+
+        cart_dict = {sku_id: count},  stocks = {sku_id: stock},不在stocks中的商品(已经不存在)不合并
+        """
+        args = []
+        for sku_id, count in cart_dict.items():
+            stock = stocks.get(sku_id)
+            if stock is not None:
+                args.extend([sku_id, count, stock])
+        if not args:
+            return self.get_total()
+        return self._run(MERGE_SCRIPT, args)
@@ -1,7 +1,7 @@
 from django.contrib import admin
-from goods.models import GoodsCategory, Goods, IndexPromotionBanner
-from celery_tasks.tasks import generate_static_index_html
-from django.core.cache import cache
+from goods.models import GoodsCategory, Goods, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
+from goods.static_html import get_dependent_pages, schedule_pages
+from orders.stock import StockReservation
 
 
 # Register your models here.
@@ -12,21 +12,30 @@ class BaseAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         """保存数据/g更新数据时调用"""
 
+        #修改数据时,修改之前依赖的页面也需要重新生成(例如商品换了分类)
+        pages = set()
+        if change:
+            old_obj = type(obj).objects.filter(pk=obj.pk).first()
+            if old_obj is not None:
+                pages = get_dependent_pages(old_obj)
+
         #执行父类的保存逻辑，实现数据的保存
-        obj.save()
+        self.save_object(request, obj, form, change)
 
-        #触发生成静态主页的异步任务
-        generate_static_index_html.delay()
+        #记录需要重新生成的静态页面 : 批量修改时,防抖窗口内只生成一次,缓存也只失效一次
+        schedule_pages(pages | get_dependent_pages(obj), catalogue_changed=True)
 
-        #手动删除缓存的数据
-        cache.delete('index_page_data')
+    def save_object(self, request, obj, form, change):
+        """保存数据 : 子类需要只保存部分字段时重写"""
+        obj.save()
 
     def delete_model(self, request, obj):
         """删除数据时调用"""
 
+        #删除之前查询依赖的页面
+        pages = get_dependent_pages(obj)
         obj.delete()
-        generate_static_index_html.delay()
-        cache.delete('index_page_data')
+        schedule_pages(pages, catalogue_changed=True)
 
 class IndexPromotionBannerAdmin(BaseAdmin):
     """IndexPromotionBanner  模型类的管理类"""
@@ -47,8 +56,43 @@ class GoodsAdmin(BaseAdmin):
 
     pass
 
+
+class GoodsSKUAdmin(BaseAdmin):
+
+    def save_object(self, request, obj, form, change):
+        """修改库存 : 按照修改的差值同时调整mysql和redis中的库存
+
+        库存和销量由下单和同步任务用F()修改,整行保存会覆盖这期间扣减的库存;
+        redis预扣库存时,stock_<sku_id>才是准确的库存,不同步修改的话下单仍然按照修改之前的库存判断
+        """
+        if not change:
+            obj.save()
+            return
+
+        delta = obj.stock - form.initial['stock']
+        obj.save(update_fields=[field.name for field in obj._meta.concrete_fields
+                                if not field.primary_key and field.name not in ('stock', 'sales')])
+        if delta:
+            StockReservation().adjust(obj.id, delta)
+
+
+class IndexGoodsBannerAdmin(BaseAdmin):
+
+    pass
+
+
+class IndexCategoryGoodsBannerAdmin(BaseAdmin):
+
+    pass
+
 admin.site.register(GoodsCategory, GoodsCategoryAdmin)
 
 admin.site.register(Goods, GoodsAdmin)
 
-admin.site.register(IndexPromotionBanner, IndexPromotionBannerAdmin)
\ No newline at end of file
+admin.site.register(GoodsSKU, GoodsSKUAdmin)
+
+admin.site.register(IndexPromotionBanner, IndexPromotionBannerAdmin)
+
+admin.site.register(IndexGoodsBanner, IndexGoodsBannerAdmin)
+
+admin.site.register(IndexCategoryGoodsBanner, IndexCategoryGoodsBannerAdmin)
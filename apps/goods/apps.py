@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class GoodsConfig(AppConfig):
+    name = 'goods'
+    verbose_name = '商品'
+
+    def ready(self):
+        # 注册信号:商品数据变化时,让缓存失效
+        import goods.signals
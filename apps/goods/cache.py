@@ -0,0 +1,366 @@
+from django.conf import settings
+from django.core.cache import cache
+from goods.models import GoodsCategory, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
+from goods.utils import SimplePage, ApproximateCountPaginator
+from django.core.paginator import EmptyPage
+from utils.cache import l1_get, l1_set, get_two_tier, invalidate_two_tier
+import math
+import random
+import time
+
+
+# 商品分类 : 一年只修改几次,同时缓存在进程内(一级)和redis(二级)
+CATEGORYS_KEY = 'goods_categorys'
+
+
+def get_categorys():
+    """查询所有的商品分类 : 大部分请求直接读取进程内缓存,不访问redis和mysql"""
+    return get_two_tier(CATEGORYS_KEY, lambda: list(GoodsCategory.objects.all()),
+                        settings.GOODS_CATEGORYS_CACHE_TIMEOUT)
+
+
+# 列表页的排序规则
+LIST_SORTS = ('default', 'price', 'hot')
+# 排序规则 : 和联合索引 (category_id, price, id), (category_id, sales, id) 对应,排序中加上id,保证分页结果稳定
+LIST_ORDERINGS = {
+    'default': ('id',),
+    'price': ('price', 'id'),
+    'hot': ('-sales', '-id'),
+}
+# 列表页每页展示的商品数
+LIST_PAGE_SIZE = 2
+# 列表页的页码列表展示当前页前后各几页
+LIST_PAGE_WINDOW = 2
+
+# 列表页缓存 : list_page_<全局版本>_<分类版本>_<category_id>_<sort>_<page_num>
+LIST_PAGE_KEY = 'list_page_%s_%s_%s_%s_%s'
+# 分类下的商品数量 : 列表页计算页数使用的近似值
+LIST_COUNT_KEY = 'list_count_%s'
+# 全局版本 : 运营在admin中修改数据时递增,所有列表页缓存失效
+LIST_VERSION_KEY = 'list_version'
+# 分类版本 : list_version_<category_id>_<sort>,库存/销量变化时递增,只让对应分类和排序的缓存失效
+LIST_CATEGORY_VERSION_KEY = 'list_version_%s_%s'
+
+
+def _incr_version(key):
+    """递增缓存版本号 : 版本号变化后,旧版本的缓存不会再被读到,等待自然过期"""
+    try:
+        cache.incr(key)
+    except ValueError:
+        # 版本号不存在
+        cache.set(key, 1, None)
+
+
+def get_list_page_key(category_id, sort, page_num):
+    """读取全局版本号和分类版本号(一次读取),返回列表页缓存的key
+
+    说明 : 查询数据之前先得到key,查询期间缓存失效时,查询结果会写入旧版本的key,不会被读到
+    """
+    category_version_key = LIST_CATEGORY_VERSION_KEY % (category_id, sort)
+    versions = cache.get_many([LIST_VERSION_KEY, category_version_key])
+    return LIST_PAGE_KEY % (versions.get(LIST_VERSION_KEY, 0), versions.get(category_version_key, 0),
+                            category_id, sort, page_num)
+
+
+def get_category_sku_count(category):
+    """查询分类下的商品数量 : 缓存GOODS_LIST_COUNT_TIMEOUT秒,是近似值,不需要每次执行COUNT(*)"""
+    key = LIST_COUNT_KEY % category.id
+    count = cache.get(key)
+    if count is None:
+        count = GoodsSKU.objects.filter(category=category).count()
+        cache.set(key, count, settings.GOODS_LIST_COUNT_TIMEOUT)
+    return count
+
+
+def make_list_cursor(sku, sort):
+    """列表页游标 : 使用当前页最后一个商品的排序值和id生成"""
+    if sort == 'price':
+        return '%s_%s' % (sku.price, sku.id)
+    elif sort == 'hot':
+        return '%s_%s' % (sku.sales, sku.id)
+    return '0_%s' % sku.id
+
+
+def build_list_page_data(category, sort, page_num):
+    """查询列表页中和登录用户无关的数据 : 页码不存在时返回第1页,调用者用page_skus.number判断"""
+
+    #查询新品推荐
+    new_skus = list(GoodsSKU.objects.filter(category=category).order_by('-create_time')[:2])
+
+    #查询category_id对应的商品sku信息,且排序
+    skus = GoodsSKU.objects.filter(category=category).order_by(*LIST_ORDERINGS[sort])
+
+    #查询分页数据 : 总数量使用缓存的近似值,不再每次执行COUNT(*)
+    paginator = ApproximateCountPaginator(skus, LIST_PAGE_SIZE, get_category_sku_count(category))
+
+    #获取用户要看那一页
+    try:
+        page_skus = paginator.page(page_num)
+    except EmptyPage:
+        page_skus = paginator.page(1)
+
+    # django的Page引用了完整的查询集,缓存前转成只包含当前页数据的SimplePage
+    page_skus = SimplePage(page_skus.object_list, page_skus.number, paginator.num_pages)
+
+    #获取页码列表 : 只展示当前页前后的页码
+    page_list = list(range(max(1, page_skus.number - LIST_PAGE_WINDOW),
+                           min(paginator.num_pages, page_skus.number + LIST_PAGE_WINDOW) + 1))
+
+    #下一页的游标 : 从当前页继续往后翻时使用游标翻页,不需要OFFSET
+    next_cursor = None
+    if page_skus.has_next() and page_skus.object_list:
+        next_cursor = make_list_cursor(page_skus.object_list[-1], sort)
+
+    return {
+        'category': category,
+        'new_skus': new_skus,
+        'page_skus': page_skus,
+        'page_list': page_list,
+        'sort': sort,
+        'next_cursor': next_cursor,
+    }
+
+
+def invalidate_list_cache(category_id=None, sorts=LIST_SORTS):
+    """列表页缓存失效 : 不指定category_id时,所有分类的列表页缓存都失效"""
+    if category_id is None:
+        _incr_version(LIST_VERSION_KEY)
+        return
+
+    for sort in sorts:
+        _incr_version(LIST_CATEGORY_VERSION_KEY % (category_id, sort))
+
+
+def invalidate_list_cache_for_sales(category_ids):
+    """商品库存/销量变化时,按照GOODS_LIST_CACHE_SALES_INVALIDATION配置的范围让列表页缓存失效
+
+    'none' : 不失效,等待缓存过期
+    'hot' : 只有人气(销量)排序的列表页失效
+    'category' : 商品所在分类的列表页全部失效
+    """
+    granularity = settings.GOODS_LIST_CACHE_SALES_INVALIDATION
+    if granularity == 'none':
+        return
+
+    sorts = ('hot',) if granularity == 'hot' else LIST_SORTS
+    for category_id in set(category_ids):
+        invalidate_list_cache(category_id, sorts)
+
+
+def _single_flight(key, lock_key, query, save, lock_timeout, wait_times):
+    """没有缓存时重建缓存 : 只有抢到锁的请求调用query()查询数据库,再调用save()写缓存,其他请求等待重建结果
+
+    说明 : 缓存的格式是 {'data':..., ...},返回查询出来的数据或者缓存中的data
+    """
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            data = query()
+            if data is not None:
+                save(data)
+            return data
+        finally:
+            cache.delete(lock_key)
+
+    # 其他请求正在重建,等待重建结果
+    for i in range(wait_times):
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['data']
+
+    # 等待超时,自己查询,不写缓存
+    return query()
+
+
+# 详情页缓存 : detail_page_<sku_id> = {'version':..., 'fresh_until':..., 'data':...}
+DETAIL_PAGE_KEY = 'detail_page_%s'
+# 详情页全局版本 : 运营在admin中修改数据时递增,所有详情页缓存变成过期数据
+DETAIL_VERSION_KEY = 'detail_version'
+# 详情页重建锁 : 同一个商品同时只有一个请求/任务在重建缓存
+DETAIL_LOCK_KEY = 'detail_lock_%s'
+
+
+def build_detail_page_data(sku_id):
+    """查询详情页中和登录用户无关的数据,商品不存在时返回None
+
+    说明 : 商品评价保存在goods.comments中,商品分类使用get_categorys(),都不在详情页缓存中
+    """
+
+    # 查询商品SKU信息 : 模板中使用了sku.category和sku.goods,一起查询出来
+    try:
+        sku = GoodsSKU.objects.select_related('category', 'goods').get(id=sku_id)
+    except GoodsSKU.DoesNotExist:
+        return None
+
+    # 查询最新推荐信息:从数据库中获取最新发布的两件商品
+    new_skus = list(GoodsSKU.objects.filter(category=sku.category).order_by('-create_time')[:2])
+
+    # 查询其他规格商品信息:exclude()  500g草莓 盒装草莓
+    other_skus = list(sku.goods.goodssku_set.exclude(id=sku.id))
+
+    return {
+        'sku': sku,
+        'new_skus': new_skus,
+        'other_skus': other_skus,
+    }
+
+
+def save_detail_page_data(sku_id, data, version=None):
+    """缓存详情页数据 : 新鲜期GOODS_DETAIL_CACHE_TIMEOUT秒,之后再保留GOODS_DETAIL_CACHE_STALE秒作为过期数据使用"""
+    if version is None:
+        version = cache.get(DETAIL_VERSION_KEY, 0)
+    entry = {
+        'version': version,
+        'fresh_until': time.time() + settings.GOODS_DETAIL_CACHE_TIMEOUT,
+        'data': data,
+    }
+    cache.set(DETAIL_PAGE_KEY % sku_id, entry,
+              settings.GOODS_DETAIL_CACHE_TIMEOUT + settings.GOODS_DETAIL_CACHE_STALE)
+
+
+def refresh_detail_page_data(sku_id):
+    """重建详情页缓存,并释放重建锁 : 后台任务使用"""
+    try:
+        data = build_detail_page_data(sku_id)
+        if data is None:
+            cache.delete(DETAIL_PAGE_KEY % sku_id)
+        else:
+            save_detail_page_data(sku_id, data)
+    finally:
+        cache.delete(DETAIL_LOCK_KEY % sku_id)
+
+
+def get_detail_page_data(sku_id):
+    """读取详情页数据(stale-while-revalidate) : 返回 (data, need_refresh)
+
+    有缓存 : 直接返回缓存,缓存过了新鲜期或者版本变化时,need_refresh为True,由调用者启动后台任务重建
+    没有缓存 : 只有抢到重建锁的请求查询数据库,其他请求等待重建结果,避免热门商品缓存失效时同时查询mysql
+    """
+    key = DETAIL_PAGE_KEY % sku_id
+    lock_key = DETAIL_LOCK_KEY % sku_id
+
+    # 一次读取缓存和版本号
+    values = cache.get_many([key, DETAIL_VERSION_KEY])
+    entry = values.get(key)
+    version = values.get(DETAIL_VERSION_KEY, 0)
+
+    if entry is not None:
+        stale = entry['fresh_until'] < time.time() or entry['version'] != version
+        need_refresh = stale and cache.add(lock_key, 1, settings.GOODS_DETAIL_LOCK_TIMEOUT)
+        return entry['data'], need_refresh
+
+    data = _single_flight(key, lock_key,
+                          lambda: build_detail_page_data(sku_id),
+                          lambda data: save_detail_page_data(sku_id, data, version),
+                          settings.GOODS_DETAIL_LOCK_TIMEOUT, settings.GOODS_DETAIL_WAIT_TIMES)
+    return data, False
+
+
+def invalidate_detail_cache(sku_id=None):
+    """详情页缓存失效 : 不指定sku_id时,所有详情页缓存变成过期数据,下次访问时在后台重建"""
+    if sku_id is None:
+        _incr_version(DETAIL_VERSION_KEY)
+    else:
+        cache.delete(DETAIL_PAGE_KEY % sku_id)
+
+
+# 主页缓存 : index_page_data = {'data':..., 'expiry':过期时间, 'delta':重建耗时}
+INDEX_PAGE_KEY = 'index_page_data'
+# 主页重建锁
+INDEX_LOCK_KEY = 'index_page_lock'
+
+
+def build_index_page_data():
+    """查询主页商品数据 : 固定4次查询,结果都是列表,缓存时不会保存惰性的查询集"""
+
+    # 查询商品分类信息
+    categorys = list(GoodsCategory.objects.all())
+
+    # 查询图片轮播信息:需求,根据index从小到大排序
+    goods_banners = list(IndexGoodsBanner.objects.all().order_by('index'))
+
+    # 查询商品活动信息:需求,根据index从小到大排序
+    promotion_banners = list(IndexPromotionBanner.objects.all().order_by('index'))
+
+    # 查询主页分类商品列表信息 : 一次查询所有分类的商品,再按照分类和展示类型分组
+    category_dict = {}
+    for category in categorys:
+        category.title_banners = []
+        category.image_banners = []
+        category_dict[category.id] = category
+
+    for banner in IndexCategoryGoodsBanner.objects.select_related('sku').order_by('index'):
+        category = category_dict.get(banner.category_id)
+        if category is None:
+            continue
+        if banner.display_type == 0:
+            category.title_banners.append(banner)
+        else:
+            category.image_banners.append(banner)
+
+    return {
+        'categorys': categorys,
+        'goods_banners': goods_banners,
+        'promotion_banners': promotion_banners,
+    }
+
+
+def save_index_page_data(data, delta):
+    """缓存主页数据 : delta是重建耗费的秒数,用于提前重建"""
+    entry = {
+        'data': data,
+        'expiry': time.time() + settings.GOODS_INDEX_CACHE_TIMEOUT,
+        'delta': delta,
+    }
+    cache.set(INDEX_PAGE_KEY, entry, settings.GOODS_INDEX_CACHE_TIMEOUT)
+
+
+def get_index_page_data():
+    """读取主页数据
+
+    进程内缓存 : 直接返回,不访问redis,也不需要反序列化
+    有缓存 : 快过期时按照概率提前重建(重建越慢,越早开始),抢到锁的一个请求重建,其他请求继续使用缓存
+    没有缓存 : 只有抢到锁的请求查询数据库,其他请求等待重建结果
+    """
+    data = l1_get(INDEX_PAGE_KEY)
+    if data is not None:
+        return data
+
+    data = _get_index_page_data()
+    if data is not None:
+        l1_set(INDEX_PAGE_KEY, data)
+    return data
+
+
+def _get_index_page_data():
+    """读取redis中缓存的主页数据"""
+    entry = cache.get(INDEX_PAGE_KEY)
+
+    if entry is not None:
+        # 提前重建的概率 : now - delta * beta * ln(random()) >= expiry, 离过期时间越近,概率越大
+        early = time.time() - entry['delta'] * settings.GOODS_INDEX_XFETCH_BETA * math.log(random.random() or 1e-12)
+        if early >= entry['expiry'] and cache.add(INDEX_LOCK_KEY, 1, settings.GOODS_INDEX_LOCK_TIMEOUT):
+            try:
+                start = time.time()
+                data = build_index_page_data()
+                save_index_page_data(data, time.time() - start)
+                return data
+            finally:
+                cache.delete(INDEX_LOCK_KEY)
+        return entry['data']
+
+    # 记录重建开始的时间
+    started = []
+
+    def query():
+        started.append(time.time())
+        return build_index_page_data()
+
+    return _single_flight(INDEX_PAGE_KEY, INDEX_LOCK_KEY, query,
+                          lambda data: save_index_page_data(data, time.time() - started[-1]),
+                          settings.GOODS_INDEX_LOCK_TIMEOUT, settings.GOODS_INDEX_WAIT_TIMES)
+
+
+def invalidate_catalogue_cache():
+    """商品分类和主页缓存失效 : 删除redis中的缓存,并通知所有进程删除进程内缓存"""
+    invalidate_two_tier(INDEX_PAGE_KEY, CATEGORYS_KEY)
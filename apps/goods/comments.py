@@ -0,0 +1,95 @@
+from django.conf import settings
+from orders.models import OrderGoods
+from users.models import User
+from utils.db_router import query_shards
+from utils.redis_store import RedisRepository
+import json
+
+
+# 商品评价 : comments_<sku_id> = [评价json, ...],最新的评价在最前面,最多保存GOODS_COMMENTS_MAX条
+# 评价json = {"username":..., "comment":..., "ctime":...},写入时已经准备好详情页需要的全部数据
+COMMENTS_KEY = 'comments_%s'
+# 标记评价已经从mysql加载到redis,没有评价的商品也需要标记
+COMMENTS_LOADED_KEY = 'comments_loaded_%s'
+
+# 保存评价 : KEYS = [comments_loaded_<sku_id>, comments_<sku_id>]  ARGV = [评价json, 最多保存的条数]
+# 评价列表和加载标记一起过期 : 没有评价的商品第一次写入时列表才创建,使用标记剩余的有效期
+ADD_COMMENT_SCRIPT = """
+local ttl = redis.call('pttl', KEYS[1])
+if ttl == -2 then
+    return 0
+end
+redis.call('lpush', KEYS[2], ARGV[1])
+redis.call('ltrim', KEYS[2], 0, tonumber(ARGV[2]) - 1)
+if ttl > 0 then
+    redis.call('pexpire', KEYS[2], ttl)
+end
+return 1
+"""
+
+
+def _dump_comment(username, comment, create_time):
+    return json.dumps({
+        'username': username,
+        'comment': comment,
+        'ctime': create_time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+
+
+def _query_comments(alias, sku_id):
+    """一个订单分库中商品最新的评价 : [(create_time, user_id, comment), ...]"""
+    return list(OrderGoods.objects.using(alias).filter(sku_id=sku_id).exclude(comment='').order_by(
+        '-create_time').values_list('create_time', 'order__user_id', 'comment')[:settings.GOODS_COMMENTS_MAX])
+
+
+class CommentStore(RedisRepository):
+    """商品评价 : 最多保存GOODS_COMMENTS_MAX条,第一次读取时从mysql加载"""
+
+    def __init__(self, sku_id, redis_conn=None):
+        super().__init__(redis_conn)
+        self.key = COMMENTS_KEY % sku_id
+        self.loaded_key = COMMENTS_LOADED_KEY % sku_id
+        self.sku_id = sku_id
+
+    def add(self, username, comment, create_time):
+        """保存一条商品评价 : 用户提交评价时调用"""
+        if not comment:
+            return
+
+        # 还没有加载过的商品不写入,读取时会从mysql中完整加载,避免只有部分评价
+        self.run_script(ADD_COMMENT_SCRIPT, [self.loaded_key, self.key],
+                        [_dump_comment(username, comment, create_time), settings.GOODS_COMMENTS_MAX])
+
+    def load(self):
+        """从mysql中加载商品评价到redis : 每个订单分库并行查询一次,合并之后再一次查询用户名"""
+        rows = []
+        for shard_rows in query_shards(lambda alias: _query_comments(alias, self.sku_id)):
+            rows.extend(shard_rows)
+        rows = sorted(rows, key=lambda row: row[0], reverse=True)[:settings.GOODS_COMMENTS_MAX]
+        usernames = dict(User.objects.filter(id__in={row[1] for row in rows}).values_list('id', 'username'))
+
+        with self.pipeline() as pipeline:
+            pipeline.delete(self.key)
+            for create_time, user_id, comment in rows:
+                pipeline.rpush(self.key, _dump_comment(usernames.get(user_id, ''), comment, create_time))
+            pipeline.expire(self.key, settings.GOODS_COMMENTS_EXPIRES)
+            pipeline.setex(self.loaded_key, settings.GOODS_COMMENTS_EXPIRES, 1)
+
+    def get(self, page=1, page_size=None):
+        """读取商品评价,一页一次redis调用 : 返回 [{"username":..., "comment":..., "ctime":...}, ...]"""
+        if page_size is None:
+            page_size = settings.GOODS_COMMENTS_PAGE_SIZE
+
+        start = (page - 1) * page_size
+        end = start + page_size - 1
+
+        with self.pipeline() as pipeline:
+            pipeline.exists(self.loaded_key)
+            pipeline.lrange(self.key, start, end)
+        loaded, comments = pipeline.results
+
+        if not loaded:
+            self.load()
+            comments = self.redis_conn.lrange(self.key, start, end)
+
+        return [json.loads(comment.decode()) for comment in comments]
@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from django.conf import settings
+from goods.models import GoodsCategory, GoodsSKU, IndexCategoryGoodsBanner
+from goods.cache import LIST_ORDERINGS, LIST_PAGE_SIZE
+from orders.models import OrderInfo, OrderGoods
+from users.models import Address
+from utils.db_router import read_primary
+
+
+# 全表扫描 : ALL 扫描整个表, index 扫描整个索引
+FULL_SCAN_TYPES = ('ALL', 'index')
+
+
+def get_hot_queries():
+    """热点查询 : [(名称, queryset), ...],参数使用数据库中已有的数据,没有数据时使用1"""
+    category_id = GoodsCategory.objects.values_list('id', flat=True).first() or 1
+    sku = GoodsSKU.objects.values_list('id', 'price', 'sales').first() or (1, 0, 0)
+    sku_id, price, sales = sku
+    user_id = OrderInfo.objects.values_list('user_id', flat=True).first() or 1
+    order = OrderInfo.objects.values_list('create_time', 'order_id').first()
+
+    skus = GoodsSKU.objects.filter(category_id=category_id)
+    queries = [
+        ('新品推荐', skus.order_by('-create_time')[:2]),
+    ]
+    for sort, ordering in sorted(LIST_ORDERINGS.items()):
+        queries.append(('列表页 %s' % sort, skus.order_by(*ordering)[:LIST_PAGE_SIZE]))
+    queries.extend([
+        ('列表页游标 price', skus.filter(Q(price__gt=price) | Q(price=price, id__gt=sku_id)).order_by(
+            *LIST_ORDERINGS['price'])[:LIST_PAGE_SIZE]),
+        ('列表页游标 hot', skus.filter(Q(sales__lt=sales) | Q(sales=sales, id__lt=sku_id)).order_by(
+            *LIST_ORDERINGS['hot'])[:LIST_PAGE_SIZE]),
+        ('商品评价', OrderGoods.objects.filter(sku_id=sku_id).exclude(comment='').order_by('-create_time').values_list(
+            'create_time', 'order__user_id', 'comment')[:settings.GOODS_COMMENTS_MAX]),
+        ('主页分类商品', IndexCategoryGoodsBanner.objects.filter(category_id=category_id, display_type=1).order_by(
+            'index')),
+        ('全部订单', OrderInfo.objects.filter(user_id=user_id).order_by('-create_time', '-order_id')[:2]),
+        ('最新地址', Address.objects.filter(user_id=user_id).order_by('-create_time')[:1]),
+    ])
+    if order is not None:
+        create_time, order_id = order
+        queries.append(('全部订单游标', OrderInfo.objects.filter(user_id=user_id).filter(
+            Q(create_time__lt=create_time) | Q(create_time=create_time, order_id__lt=order_id)).order_by(
+            '-create_time', '-order_id')[:2]))
+    return queries
+
+
+def explain(connection, queryset):
+    """执行EXPLAIN : 返回 [{列名: 值}, ...],每个表一行"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class Command(BaseCommand):
+    """检查热点查询的执行计划 : python manage.py explain_hot_queries
+
+    对每个热点查询执行EXPLAIN,有全表扫描或者filesort时返回错误,用于上线前确认索引已经生效.
+    表中的数据太少时mysql可能直接选择全表扫描,估计行数少于--min-rows的只提示,不算错误
+    """
+
+    help = '检查热点查询的执行计划,有全表扫描时失败'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='数据库别名,默认是主库')
+        parser.add_argument('--min-rows', type=int, default=100, help='估计行数少于这个值的全表扫描只提示')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'mysql':
+            raise CommandError('只支持mysql : %s' % connection.vendor)
+
+        failed = []
+        with read_primary():
+            queries = get_hot_queries()
+        for name, queryset in queries:
+            for row in explain(connection, queryset):
+                extra = row.get('Extra') or ''
+                rows = row.get('rows') or 0
+                problem = None
+                if row.get('type') in FULL_SCAN_TYPES:
+                    problem = '全表扫描(%s)' % row['type']
+                elif 'Using filesort' in extra:
+                    problem = 'filesort'
+                if problem is None:
+                    self.stdout.write('%s : %s %s key=%s rows=%s' % (name, row['table'], row['type'], row['key'], rows))
+                elif rows < options['min_rows']:
+                    self.stdout.write('%s : %s %s,估计%s行,数据太少,忽略' % (name, row['table'], problem, rows))
+                else:
+                    self.stderr.write('%s : %s %s,估计%s行 %s' % (name, row['table'], problem, rows, extra))
+                    failed.append(name)
+
+        if failed:
+            raise CommandError('以下查询没有使用索引 : %s' % ', '.join(sorted(set(failed))))
+        self.stdout.write('所有热点查询都使用了索引')
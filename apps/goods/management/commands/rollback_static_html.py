@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from goods.static_html import get_manifest, rollback_page
+
+
+class Command(BaseCommand):
+    """回滚静态页面到上一个版本 : python manage.py rollback_static_html [page ...]
+
+    不指定页面时回滚所有页面,例如 python manage.py rollback_static_html index detail/5
+    """
+
+    help = '回滚静态页面到上一个版本'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*', help="页面名称,例如 index, list/1/1_default, detail/5")
+
+    def handle(self, *args, **options):
+        pages = options['pages'] or sorted(get_manifest())
+        for page in pages:
+            version = rollback_page(page)
+            if version is None:
+                self.stdout.write('%s : 没有上一个版本' % page)
+            else:
+                self.stdout.write('%s : 已回滚到 %s' % (page, version))
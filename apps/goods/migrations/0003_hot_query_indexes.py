@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0002_goodssku_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='goodssku',
+            index_together=set([('category', 'price', 'id'), ('category', 'sales', 'id'), ('category', 'create_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='indexcategorygoodsbanner',
+            index_together=set([('category', 'display_type', 'index')]),
+        ),
+    ]
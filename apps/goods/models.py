@@ -52,6 +52,12 @@ class GoodsSKU(BaseModel):
         db_table = "df_goods_sku"
         verbose_name = "商品SKU"
         verbose_name_plural = verbose_name
+        # 列表页按价格/人气排序分页时使用的联合索引,列表页和详情页的新品推荐按类别查询最新的商品
+        index_together = [
+            ("category", "price", "id"),
+            ("category", "sales", "id"),
+            ("category", "create_time"),
+        ]
 
     def __str__(self):
         return self.name
@@ -101,6 +107,10 @@ class IndexCategoryGoodsBanner(BaseModel):
         db_table = "df_index_category_goods"
         verbose_name = "主页分类展示商品"
         verbose_name_plural = verbose_name
+        # 主页按类别查询标题/图片展示的商品,按顺序排列
+        index_together = [
+            ("category", "display_type", "index"),
+        ]
 
     def __str__(self):
         return str(self.sku)
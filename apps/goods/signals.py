@@ -0,0 +1,18 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from goods.models import GoodsSKU, GoodsImage
+from goods.cache import invalidate_detail_cache
+
+
+@receiver([post_save, post_delete], sender=GoodsSKU)
+def sku_changed(sender, instance, **kwargs):
+    """商品SKU修改/删除 : 它的详情页和同一商品其他规格的详情页都展示了它"""
+    invalidate_detail_cache(instance.id)
+    for sku_id in GoodsSKU.objects.filter(goods_id=instance.goods_id).values_list('id', flat=True):
+        invalidate_detail_cache(sku_id)
+
+
+@receiver([post_save, post_delete], sender=GoodsImage)
+def image_changed(sender, instance, **kwargs):
+    """商品图片修改/删除"""
+    invalidate_detail_cache(instance.sku_id)
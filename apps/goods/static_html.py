@@ -0,0 +1,412 @@
+r"""静态页面 : 由celery生成到STATIC_HTML_DIR,nginx直接返回,不经过django
+
+页面名称和文件 (相对STATIC_HTML_DIR) :
+    主页 : 'index' -> index.html
+    列表页 : 'list/<category_id>/<page_num>_<sort>' -> list/<category_id>/<page_num>_<sort>.html
+    详情页 : 'detail/<sku_id>' -> detail/<sku_id>.html
+
+每次生成的内容保存在带内容hash的版本文件中(例如 detail/5.3f2a9c1e0b7d.html),
+页面文件是指向当前版本的符号链接,通过rename原子切换,redis中记录每个页面最近的版本,用于回滚
+
+nginx配置示例 : 文件不存在时交给django;try_files不看查询参数,带cursor的游标分页请求没有静态页面,也交给django
+    location ~ ^/list/(\d+)/(\d+)$ {
+        error_page 418 = @django;
+        if ($arg_cursor) { return 418; }
+        set $sort default;
+        if ($arg_sort ~ ^(price|hot)$) { set $sort $arg_sort; }
+        try_files /list/$1/$2_$sort.html @django;
+    }
+    location ~ ^/detail/(\d+)$ { try_files /detail/$1.html @django; }
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.template import loader
+from goods.models import GoodsCategory, Goods, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
+from goods.cache import LIST_SORTS, LIST_PAGE_SIZE, LIST_COUNT_KEY, build_index_page_data, build_list_page_data, \
+    build_detail_page_data, get_categorys
+from goods.comments import CommentStore
+from utils.redis_store import RedisRepository
+import tempfile
+import hashlib
+import math
+import time
+import uuid
+import os
+
+
+INDEX_PAGE = 'index'
+LIST_PAGE = 'list/%s/%s_%s'
+DETAIL_PAGE = 'detail/%s'
+
+# 页面的生成代数 : static_generation_<page>,每次请求生成时递增,只有最新一代的生成结果会被使用
+GENERATION_KEY = 'static_generation_%s'
+# 页面的版本记录 : static_versions_<page> = [hash, ...],当前版本在最前面,最多保留STATIC_HTML_KEEP_VERSIONS个
+VERSIONS_KEY = 'static_versions_%s'
+# 所有页面的当前版本 : static_manifest = {page: hash}
+MANIFEST_KEY = 'static_manifest'
+# 切换页面版本的锁
+SWITCH_LOCK_KEY = 'static_switch_lock_%s'
+# 等待生成的页面 : static_dirty = {page, ...},防抖窗口结束时一起生成
+DIRTY_KEY = 'static_dirty'
+# 商品数据有修改,防抖窗口结束时缓存失效
+CATALOGUE_DIRTY_KEY = 'static_catalogue_dirty'
+# 防抖标记 : 存在时说明已经安排了刷新任务
+DEBOUNCE_KEY = 'static_debounce'
+
+
+class StaticPageState(RedisRepository):
+    """静态页面在redis中的状态 : 生成代数,版本记录,当前版本清单,等待生成的页面"""
+
+    def next_generations(self, pages):
+        """递增页面的生成代数 : 返回 [[page, generation], ...],一次往返"""
+        with self.pipeline() as pipeline:
+            for page in pages:
+                pipeline.incr(GENERATION_KEY % page)
+        return [[page, generation] for page, generation in zip(pages, pipeline.results)]
+
+    def is_current(self, page, generation):
+        """是否还是最新一代"""
+        current = self.redis_conn.get(GENERATION_KEY % page)
+        return current is None or int(current) == generation
+
+    def get_versions(self, page, count=None):
+        """页面的版本记录 : [hash, ...],当前版本在最前面,count是最多读取的数量"""
+        versions = self.redis_conn.lrange(VERSIONS_KEY % page, 0, -1 if count is None else count - 1)
+        return [version.decode() for version in versions]
+
+    def push_version(self, page, version):
+        """记录当前版本 : 返回超出保留数量被删除的旧版本,一次往返"""
+        key = VERSIONS_KEY % page
+        with self.pipeline() as pipeline:
+            pipeline.lrem(key, 0, version)
+            pipeline.lpush(key, version)
+            pipeline.lrange(key, settings.STATIC_HTML_KEEP_VERSIONS, -1)
+            pipeline.ltrim(key, 0, settings.STATIC_HTML_KEEP_VERSIONS - 1)
+            pipeline.hset(MANIFEST_KEY, page, version)
+        return [old_version.decode() for old_version in pipeline.results[2]]
+
+    def drop_version(self, page, current, previous):
+        """回滚 : 删除当前版本的记录,上一个版本成为当前版本"""
+        with self.pipeline() as pipeline:
+            pipeline.lrem(VERSIONS_KEY % page, 0, current)
+            pipeline.hset(MANIFEST_KEY, page, previous)
+
+    def remove(self, page):
+        """删除页面的所有版本记录"""
+        with self.pipeline() as pipeline:
+            pipeline.delete(VERSIONS_KEY % page)
+            pipeline.hdel(MANIFEST_KEY, page)
+
+    def get_manifest(self):
+        """所有页面的当前版本 : {page: hash}"""
+        manifest = self.redis_conn.hgetall(MANIFEST_KEY)
+        return {page.decode(): version.decode() for page, version in manifest.items()}
+
+    def mark_dirty(self, pages, catalogue_changed=False):
+        """记录等待生成的页面 : 返回是否设置了防抖标记(需要安排刷新任务),一次往返"""
+        with self.pipeline() as pipeline:
+            if pages:
+                pipeline.sadd(DIRTY_KEY, *pages)
+            if catalogue_changed:
+                pipeline.set(CATALOGUE_DIRTY_KEY, 1)
+            # 防抖标记设置成功的请求负责安排刷新任务,设置有效期,刷新任务丢失时之后的请求可以重新安排
+            pipeline.set(DEBOUNCE_KEY, 1, nx=True, ex=settings.STATIC_HTML_DEBOUNCE * 10)
+        return bool(pipeline.results[-1])
+
+    def pop_dirty(self):
+        """取出等待生成的页面 : 返回 (pages, catalogue_changed),先删除防抖标记
+
+        说明 : 读取和删除在一个事务(MULTI/EXEC)中执行,中间不会插入mark_dirty,新标记的页面不会被删除
+        """
+        with self.pipeline(transaction=True) as pipeline:
+            pipeline.delete(DEBOUNCE_KEY)
+            pipeline.smembers(DIRTY_KEY)
+            pipeline.get(CATALOGUE_DIRTY_KEY)
+            pipeline.delete(DIRTY_KEY, CATALOGUE_DIRTY_KEY)
+        return [page.decode() for page in pipeline.results[1]], pipeline.results[2] is not None
+
+
+def get_static_path(page):
+    """页面名称对应的静态文件路径"""
+    return os.path.join(settings.STATIC_HTML_DIR, page + '.html')
+
+
+def write_static_html(path, html_data):
+    """原子写入静态文件 : 先写到同一目录下的临时文件,再rename替换,nginx不会读到写了一半的文件"""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(html_data)
+        # mkstemp创建的文件只有自己可读,nginx需要读取
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def render_index_html():
+    """渲染静态主页"""
+
+    #查询主页商品数据 : 分类,图片轮播,活动,分类商品列表
+    context = build_index_page_data()
+
+    #静态页面不展示购物车数量
+    context.update(cart_num=0)
+
+    return loader.get_template('static_index.html').render(context)
+
+
+def render_list_html(category_id, sort, page_num):
+    """渲染静态列表页,分类或者页码不存在时返回None"""
+    try:
+        category = GoodsCategory.objects.get(id=category_id)
+    except GoodsCategory.DoesNotExist:
+        return None
+
+    context = build_list_page_data(category, sort, page_num)
+    if context['page_skus'].number != page_num:
+        return None
+
+    context.update(categorys=get_categorys(), cart_num=0, base_template='static_base.html', static_page=True)
+    return loader.get_template('list.html').render(context)
+
+
+def render_detail_html(sku_id):
+    """渲染静态详情页,商品不存在时返回None"""
+    data = build_detail_page_data(sku_id)
+    if data is None:
+        return None
+
+    context = dict(data, categorys=get_categorys(), sku_orders=CommentStore(sku_id).get(), cart_num=0,
+                   base_template='static_base.html', static_page=True)
+    return loader.get_template('detail.html').render(context)
+
+
+def render_page(page):
+    """按照页面名称渲染,页面不存在时返回None"""
+    if page == INDEX_PAGE:
+        return render_index_html()
+
+    kind, args = page.split('/', 1)
+    if kind == 'list':
+        category_id, name = args.split('/')
+        page_num, sort = name.split('_')
+        return render_list_html(int(category_id), sort, int(page_num))
+    elif kind == 'detail':
+        return render_detail_html(int(args))
+    raise ValueError('未知的静态页面 : %s' % page)
+
+
+def _get_version_path(page, version):
+    """页面版本文件的路径"""
+    return os.path.join(settings.STATIC_HTML_DIR, '%s.%s.html' % (page, version))
+
+
+def _switch_link(path, target):
+    """原子切换符号链接 : 先创建临时链接,再rename覆盖页面文件"""
+    tmp_path = os.path.join(os.path.dirname(path), '.%s.tmp' % uuid.uuid4().hex)
+    os.symlink(os.path.basename(target), tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _remove_file(path):
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def next_generations(pages):
+    """递增页面的生成代数 : 返回 [[page, generation], ...],之前请求的生成结果都会被丢弃"""
+    return StaticPageState().next_generations(pages)
+
+
+def _acquire_switch_lock(page):
+    """获取切换页面版本的锁,最多等待1秒"""
+    lock_key = SWITCH_LOCK_KEY % page
+    for i in range(20):
+        if cache.add(lock_key, 1, settings.STATIC_HTML_LOCK_TIMEOUT):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def _activate_version(state, page, version):
+    """切换到指定版本,记录版本,删除超出保留数量的旧版本文件 : 持有切换锁时调用"""
+    _switch_link(get_static_path(page), _get_version_path(page, version))
+
+    for old_version in state.push_version(page, version):
+        _remove_file(_get_version_path(page, old_version))
+
+
+def _remove_page(state, page):
+    """页面已经不存在 : 删除页面文件和所有版本,nginx会交给django处理"""
+    _remove_file(get_static_path(page))
+
+    for version in state.get_versions(page):
+        _remove_file(_get_version_path(page, version))
+    state.remove(page)
+
+
+def generate_page(page, generation=None):
+    """生成一个静态页面 : 返回是否切换了页面
+
+    generation是请求生成时的代数,已经有更新的请求时直接跳过,生成期间有新的请求时丢弃这次的结果.
+    内容没有变化时不写文件;内容变化时写入新的版本文件,再切换符号链接
+    """
+    # 生成期间又有新的请求时,不再使用这次的结果
+    state = StaticPageState()
+    if generation is not None and not state.is_current(page, generation):
+        return False
+
+    html_data = render_page(page)
+
+    version = None
+    if html_data is not None:
+        version = hashlib.md5(html_data.encode('utf-8')).hexdigest()[:12]
+        version_path = _get_version_path(page, version)
+        if not os.path.exists(version_path):
+            write_static_html(version_path, html_data)
+
+    if not _acquire_switch_lock(page):
+        raise RuntimeError('切换静态页面超时 : %s' % page)
+    try:
+        if generation is not None and not state.is_current(page, generation):
+            return False
+        if version is None:
+            _remove_page(state, page)
+        else:
+            _activate_version(state, page, version)
+        return True
+    finally:
+        cache.delete(SWITCH_LOCK_KEY % page)
+
+
+def rollback_page(page):
+    """回滚到上一个版本 : 当前版本被删除,返回回滚后的版本,没有上一个版本时返回None
+
+    说明 : 回滚不会阻止之后的生成,再次修改数据时会重新生成
+    """
+    state = StaticPageState()
+    if not _acquire_switch_lock(page):
+        raise RuntimeError('切换静态页面超时 : %s' % page)
+    try:
+        versions = state.get_versions(page, 2)
+        if len(versions) < 2:
+            return None
+
+        current, previous = versions
+        _switch_link(get_static_path(page), _get_version_path(page, previous))
+
+        state.drop_version(page, current, previous)
+        _remove_file(_get_version_path(page, current))
+        return previous
+    finally:
+        cache.delete(SWITCH_LOCK_KEY % page)
+
+
+def schedule_pages(pages, catalogue_changed=False):
+    """记录需要重新生成的页面 : STATIC_HTML_DEBOUNCE秒内的多次请求合并成一个刷新任务
+
+    catalogue_changed : 运营修改了商品数据,刷新时让主页/列表页/详情页的缓存失效
+    """
+    # 避免循环导入 : celery_tasks.tasks导入了本模块
+    from celery_tasks.tasks import flush_static_pages
+
+    if StaticPageState().mark_dirty(pages, catalogue_changed):
+        flush_static_pages.apply_async(countdown=settings.STATIC_HTML_DEBOUNCE)
+
+
+def pop_dirty_pages():
+    """取出等待生成的页面 : 返回 (pages, catalogue_changed)
+
+    说明 : 先删除防抖标记,之后的请求会安排新的刷新任务,不会遗漏
+    """
+    return StaticPageState().pop_dirty()
+
+
+def get_manifest():
+    """所有页面的当前版本 : {page: hash}"""
+    return StaticPageState().get_manifest()
+
+
+def _get_generated_pages(kind):
+    """已经生成的静态页面 : 用于删除已经不存在的列表页和详情页"""
+    pages = []
+    root = os.path.join(settings.STATIC_HTML_DIR, kind)
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            # 只要页面文件,不要版本文件 : 版本文件的名称中有hash
+            if filename.endswith('.html') and filename.count('.') == 1:
+                path = os.path.join(dirpath, filename[:-len('.html')])
+                pages.append(os.path.relpath(path, settings.STATIC_HTML_DIR).replace(os.sep, '/'))
+    return pages
+
+
+def get_category_list_pages(category_id):
+    """分类的所有列表页 : 所有排序的所有页码,以及已经生成过的页码(商品减少后需要删除)
+
+    说明 : 同时用准确的商品数量更新列表页使用的近似数量,保证静态页的页码和商品一致
+    """
+    count = GoodsSKU.objects.filter(category_id=category_id).count()
+    cache.set(LIST_COUNT_KEY % category_id, count, settings.GOODS_LIST_COUNT_TIMEOUT)
+
+    num_pages = max(1, int(math.ceil(count / LIST_PAGE_SIZE)))
+    pages = set(LIST_PAGE % (category_id, page_num, sort)
+                for sort in LIST_SORTS for page_num in range(1, num_pages + 1))
+    pages.update(_get_generated_pages('list/%s' % category_id))
+    return pages
+
+
+def get_all_pages():
+    """全部静态页面 : 分类变化时,所有页面的分类导航都需要重新生成"""
+    pages = {INDEX_PAGE}
+    for category_id in GoodsCategory.objects.values_list('id', flat=True):
+        pages.update(get_category_list_pages(category_id))
+    pages.update(DETAIL_PAGE % sku_id for sku_id in GoodsSKU.objects.values_list('id', flat=True))
+    pages.update(_get_generated_pages('list'))
+    pages.update(_get_generated_pages('detail'))
+    return pages
+
+
+def get_sku_pages(sku):
+    """商品SKU变化时需要重新生成的页面
+
+    自己和同一商品其他规格的详情页(其他规格中展示了价格),所在分类的列表页,
+    是分类中最新的两个商品时,分类中所有的详情页(新品推荐),在主页中展示时,主页
+    """
+    pages = set(DETAIL_PAGE % sku_id
+                for sku_id in GoodsSKU.objects.filter(goods_id=sku.goods_id).values_list('id', flat=True))
+    pages.add(DETAIL_PAGE % sku.id)
+    pages.update(get_category_list_pages(sku.category_id))
+
+    # 删除的商品也要判断 : 比第二新的商品新,说明在新品推荐中
+    newest = list(GoodsSKU.objects.filter(category_id=sku.category_id).order_by(
+        '-create_time').values_list('create_time', flat=True)[:2])
+    if len(newest) < 2 or sku.create_time >= newest[-1]:
+        pages.update(DETAIL_PAGE % sku_id for sku_id in GoodsSKU.objects.filter(
+            category_id=sku.category_id).values_list('id', flat=True))
+
+    if IndexGoodsBanner.objects.filter(sku_id=sku.id).exists() or \
+            IndexCategoryGoodsBanner.objects.filter(sku_id=sku.id).exists():
+        pages.add(INDEX_PAGE)
+    return pages
+
+
+def get_dependent_pages(obj):
+    """依赖关系 : 返回数据变化时需要重新生成的页面名称集合"""
+    if isinstance(obj, GoodsCategory):
+        return get_all_pages()
+    elif isinstance(obj, GoodsSKU):
+        return get_sku_pages(obj)
+    elif isinstance(obj, Goods):
+        return set(DETAIL_PAGE % sku_id for sku_id in obj.goodssku_set.values_list('id', flat=True))
+    elif isinstance(obj, (IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner)):
+        return {INDEX_PAGE}
+    return set()
@@ -9,6 +9,12 @@ urlpatterns = [
     # 详情 : http://127.0.0.1:8000/detail/10
     url(r'^detail/(?P<sku_id>\d+)$', views.DetailView.as_view(), name='detail'),
 
+    # 更多评价 : http://127.0.0.1:8000/detail/10/comments?page=2
+    url(r'^detail/(?P<sku_id>\d+)/comments$', views.CommentListView.as_view(), name='comments'),
+
+    # 静态页面的动态数据 : http://127.0.0.1:8000/page/state
+    url(r'^page/state$', views.PageStateView.as_view(), name='page_state'),
+
     #列表页
     url(r'^list/(?P<category_id>\d+)/(?P<page_num>\d+)$', views.ListView.as_view(), name='list'),
 
@@ -0,0 +1,72 @@
+from django.core.paginator import Paginator
+from goods.models import GoodsSKU
+
+
+def parse_sku_id(sku_id):
+    """把sku_id统一转成int:redis中读取的是bytes,cookie和请求参数中是str,非法的返回None"""
+    if isinstance(sku_id, bytes):
+        sku_id = sku_id.decode()
+    try:
+        return int(sku_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_skus_by_ids(sku_ids):
+    """批量查询商品SKU:一次查询,返回 {sku_id(int): sku} 字典
+
+    说明 : 不存在或不合法的sku_id不会出现在字典中,调用者用 dict.get() 判断商品是否存在
+    """
+    ids = set()
+    for sku_id in sku_ids:
+        sku_id = parse_sku_id(sku_id)
+        if sku_id is not None:
+            ids.add(sku_id)
+
+    if not ids:
+        return {}
+
+    # in_bulk : SELECT ... WHERE id IN (...), 无论多少个sku_id都只查询一次
+    return GoodsSKU.objects.in_bulk(list(ids))
+
+
+class SimplePage(object):
+    """可以缓存的分页结果 : 只保存当前页的数据和页码,模板中的用法和django的Page一致
+
+    说明 : django的Page引用了完整的查询集,缓存(pickle)时会把整个查询集查询出来
+    """
+
+    def __init__(self, object_list, number, num_pages):
+        self.object_list = list(object_list)
+        self.number = number
+        self.num_pages = num_pages
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+
+class ApproximateCountPaginator(Paginator):
+    """使用缓存的近似总数量分页,不再每次执行COUNT(*)"""
+
+    def __init__(self, object_list, per_page, approximate_count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.approximate_count = approximate_count
+
+    @property
+    def count(self):
+        return self.approximate_count
@@ -1,11 +1,20 @@
 from django.shortcuts import render, redirect
 from django.views.generic import View
-from goods.models import GoodsCategory, Goods, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
+from goods.models import GoodsCategory, GoodsSKU
 from django.core.cache import cache
-from django_redis import get_redis_connection
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator, EmptyPage
-import json
+from django.conf import settings
+from goods.cache import LIST_SORTS, LIST_ORDERINGS, LIST_PAGE_SIZE, get_list_page_key, build_list_page_data, \
+    get_detail_page_data, get_index_page_data, get_categorys, make_list_cursor
+from celery_tasks.tasks import refresh_detail_cache
+from goods.comments import CommentStore
+from goods.utils import parse_sku_id
+from cart.storage import RedisCart
+from users.history import BrowseHistory
+from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.db.models import Q
+from decimal import Decimal
 
 # Create your views here.
 
@@ -19,29 +28,12 @@ class BaseCartView(View):
 
         # 如果是登录用户,读取购物车数据
         if request.user.is_authenticated():
-            # 创建连接到redis的对象
-            redis_conn = get_redis_connection('default')
-
-            # 调用hgetall(), 读取所有的购物车数据
-            user_id = request.user.id
-            cart_dict = redis_conn.hgetall('cart_%s' % user_id)
-
-            # 遍历cart_dict,取出数量,累加求和
-            # 说明:hgetall()返回的字典,里面的key和value是字节类型(bytes)的,所以在计算和比较时需要对类型进行处理
-            for val in cart_dict.values():
-                cart_num += int(val)
+            # 读取购物车中的商品总数量 : 修改购物车时已经维护好总数量,不需要遍历购物车
+            cart_num = RedisCart(request.user.id).get_total()
 
         else:
-            #cookie中存储的是json字符串
-            cart_json = request.COOKIES.get('cart')
-            if cart_json is not None:
-                cart_dict = json.loads(cart_json)
-            else:
-                cart_dict = {}
-
-            #遍历cart_dict,取出count,求和
-            for val in cart_dict.values():
-                cart_num += int(val) #val 是int类型
+            #cookie中的购物车 : CartCookieMiddleware已经解析好
+            cart_num = request.cookie_cart.get_total()
 
         return cart_num
 
@@ -49,180 +41,179 @@ class BaseCartView(View):
 class ListView(BaseCartView):
     """列表页"""
 
+    # 每页展示的商品数
+    page_size = LIST_PAGE_SIZE
+    # 排序规则 : 和联合索引 (category_id, price, id), (category_id, sales, id) 对应
+    orderings = LIST_ORDERINGS
+
     def get(self, request, category_id, page_num):
         """查询数据，渲染模板，实现分页和排序"""
 
         #获取排序规则：   提示：如果用户不传？sort='',给个默认的值即可
         #?sort=default  ?sort=price   ?sort=hot
         sort = request.GET.get('sort', 'default')
+        if sort not in LIST_SORTS:
+            sort = 'default'
 
+        page_num = int(page_num)
 
-        #查询用户要看的商品分类  category_id对应的
-        try:
-            category = GoodsCategory.objects.get(id=category_id)
-        except GoodsCategory.DoesNotExist:
-            return redirect(reverse('goods:index'))
+        #游标翻页 : ?cursor=最后一个商品的排序值_id, 深分页时不需要 OFFSET
+        cursor = request.GET.get('cursor')
+        if cursor:
+            return self.get_cursor_page(request, category_id, sort, cursor)
 
-        #查询所有的商品分类
-        categorys = GoodsCategory.objects.all()
+        #读取缓存数据 : 按照 (category_id, sort, page_num) 缓存
+        cache_key = get_list_page_key(category_id, sort, page_num)
+        context = cache.get(cache_key)
+        if context is None:
 
-        #查询新品推荐
-        new_skus = GoodsSKU.objects.filter(category=category).order_by('-create_time')[:2]
+            #查询用户要看的商品分类  category_id对应的
+            try:
+                category = GoodsCategory.objects.get(id=category_id)
+            except GoodsCategory.DoesNotExist:
+                return redirect(reverse('goods:index'))
 
+            #查询列表页数据 : 新品推荐,当前页的商品和页码列表
+            context = build_list_page_data(category, sort, page_num)
+            page_skus = context['page_skus']
 
-        #查询category_id对应的商品sku信息,且排序
-        if sort == 'price':
-            skus = GoodsSKU.objects.filter(category=category).order_by('price')
-        elif sort == 'hot':
-            skus = GoodsSKU.objects.filter(category=category).order_by('-sales')
-        else:
-            skus = GoodsSKU.objects.filter(category=category)
-            sort = 'default'
+            #缓存上下文 : 页码不存在时展示的是第1页,不缓存,避免随意的页码占用缓存
+            if page_skus.number == page_num:
+                cache.set(cache_key, context, settings.GOODS_LIST_CACHE_TIMEOUT)
 
 
         # 查询购物车信息
         cart_num = self.get_cart_num(request)
 
+        # 更新context : 商品分类读取进程内缓存,不在列表页缓存中
+        context = dict(context, categorys=get_categorys(), cart_num=cart_num)
 
-        #查询分页数据  paginator  page
-        # paginator = [GoodsSKU, GoodsSKU, GoodsSKU, GoodsSKU, GoodsSKU, ...]
-        paginator = Paginator(skus, 2)
+        #渲染模板
+        return render(request, 'list.html', context)
+
+    def get_cursor_page(self, request, category_id, sort, cursor):
+        """游标翻页 : 使用联合索引 (category_id, price/sales, id) 定位,第500页和第1页的查询代价一样"""
 
-        #获取用户要看那一页  page = [GoodsSKU, GoodsSKU,]
-        page_num = int(page_num)
         try:
-            page_skus = paginator.page(page_num)
-        except EmptyPage:
-            page_skus = paginator.page(1)
+            category = GoodsCategory.objects.get(id=category_id)
+        except GoodsCategory.DoesNotExist:
+            return redirect(reverse('goods:index'))
+
+        skus = GoodsSKU.objects.filter(category=category).order_by(*self.orderings[sort])
 
+        #查询游标之后的商品,多查一个用于判断是否有下一页
+        try:
+            value, sku_id = cursor.rsplit('_', 1)
+            sku_id = int(sku_id)
+            if sort == 'price':
+                value = Decimal(value)
+                skus = skus.filter(Q(price__gt=value) | Q(price=value, id__gt=sku_id))
+            elif sort == 'hot':
+                value = int(value)
+                skus = skus.filter(Q(sales__lt=value) | Q(sales=value, id__lt=sku_id))
+            else:
+                skus = skus.filter(id__gt=sku_id)
+        except (ValueError, ArithmeticError):
+            return redirect(reverse('goods:list', args=(category_id, 1)) + '?sort=' + sort)
 
-        #获取页码列表
-        page_list = paginator.page_range
+        skus = list(skus[:self.page_size + 1])
+        next_cursor = None
+        if len(skus) > self.page_size:
+            skus = skus[:self.page_size]
+            next_cursor = self.make_cursor(skus[-1], sort)
 
-        #构造上下文
         context = {
             'category': category,
-            'categorys': categorys,
-            'new_skus': new_skus,
-            'page_skus': page_skus,
-            'page_list': page_list,
+            'categorys': get_categorys(),
+            'new_skus': GoodsSKU.objects.filter(category=category).order_by('-create_time')[:2],
+            'page_skus': skus,
             'sort': sort,
-            'cart_num': cart_num
+            'cursor_mode': True,
+            'next_cursor': next_cursor,
+            'cart_num': self.get_cart_num(request),
         }
 
-
-        #渲染模板
         return render(request, 'list.html', context)
 
+    def make_cursor(self, sku, sort):
+        """使用当前页最后一个商品的排序值和id生成游标"""
+        return make_list_cursor(sku, sort)
+
 class DetailView(BaseCartView):
     """详情"""
 
     def get(self, request, sku_id):
         """查询详情页数据,渲染模板"""
 
-        # 查询商品SKU信息
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        # 读取缓存数据 : 商品SKU,新品推荐,其他规格,和登录用户无关,每个商品缓存一份
+        data, need_refresh = get_detail_page_data(sku_id)
+        if data is None:
+            # 商品不存在
             return redirect(reverse('goods:index'))
 
-        # 查询商品分类信息
-        categorys = GoodsCategory.objects.all()
-
-        # 查询商品评价信息:从订单中获取评论信息
-        sku_orders = sku.ordergoods_set.all().order_by('-create_time')[:30]
-        if sku_orders:
-            for sku_order in sku_orders:
-                sku_order.ctime = sku_order.create_time.strftime('%Y-%m-%d %H:%M:%S')
-                sku_order.username = sku_order.order.user.username
-        else:
-            sku_orders = []
+        # 缓存已经过期:先使用过期数据响应,后台重建缓存
+        if need_refresh:
+            refresh_detail_cache.delay(sku_id)
 
-        # 查询最新推荐信息:从数据库中获取最新发布的两件商品
-        new_skus = GoodsSKU.objects.filter(category=sku.category).order_by('-create_time')[:2]
-
-        # 查询其他规格商品信息:exclude()  500g草莓 盒装草莓
-        other_skus = sku.goods.goodssku_set.exclude(id=sku.id)
-        """
-        sku = 500g草莓
-        sku.goods = 草莓
-        sku.goods.goodssku_set = 500g草莓 盒装草莓 1000g草莓
-        sku.goods.goodssku_set.exclude(id=500g草莓_id)
-        """
+        # 查询商品评价信息 : 评价已经包含用户名和时间,一次redis调用
+        sku_orders = CommentStore(sku_id).get()
 
         # 查询购物车信息
         cart_num = self.get_cart_num(request)
 
-        # 如果是登录用户,读取购物车数据
+        # 如果是登录用户,记录浏览信息 : 一次往返
         if request.user.is_authenticated():
-            # 创建连接到redis的对象
-            redis_conn = get_redis_connection('default')
-
-            # 调用hgetall(), 读取所有的购物车数据
-            user_id = request.user.id
-
-            # 删除重复的sku_id
-            redis_conn.lrem('history_%s' % user_id, 0, sku_id)
-            # 记录浏览信息
-            redis_conn.lpush('history_%s' % user_id, sku_id)
-            # 最多保存五条记录
-            redis_conn.ltrim('history_%s' % user_id, 0, 4)
+            BrowseHistory(request.user.id).add(sku_id)
 
         # 构造上下文
-        context = {
-            'sku': sku,
-            'categorys': categorys,
-            'sku_orders': sku_orders,
-            'new_skus': new_skus,
-            'other_skus': other_skus,
-            'cart_num': cart_num
-        }
+        context = dict(data)
+        context.update(categorys=get_categorys(), sku_orders=sku_orders, cart_num=cart_num)
 
 
         # 渲染模板
         return render(request, 'detail.html', context)
 
 
-class IndexView(BaseCartView):
-    """主页"""
+class CommentListView(View):
+    """商品评价:查看更多评价"""
 
-    def get(self, request):
-        """查询主页商品数据,渲染模板"""
+    def get(self, request, sku_id):
+        """分页读取商品评价,响应json"""
 
-        # 读取缓存数据
-        context = cache.get('index_page_data')
-        if context is None:
-            print('没有缓存,查询数据')
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            return JsonResponse({'code': 1, 'message': '页码错误'})
 
-            # 查询用户user信息:在request中
-            # 查询商品分类信息
-            categorys = GoodsCategory.objects.all()
+        # 商品不存在时不加载评价 : 否则任意的sku_id都会查询所有分库,并在redis中留下加载标记
+        if not GoodsSKU.objects.filter(id=sku_id).exists():
+            return JsonResponse({'code': 2, 'message': '商品不存在'}, status=404)
 
-            # 查询图片轮播信息:需求,根据index从小到大排序
-            goods_banners = IndexGoodsBanner.objects.all().order_by('index')
+        comments = CommentStore(sku_id).get(page)
 
-            # 查询商品活动信息:需求,根据index从小到大排序
-            promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
+        return JsonResponse({'code': 0, 'comments': comments, 'page': page})
 
-            # 查询主页分类商品列表信息
-            for category in categorys:
-                title_banners = IndexCategoryGoodsBanner.objects.filter(category=category,display_type=0)
-                category.title_banners = title_banners
 
-                image_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=1)
-                category.image_banners = image_banners
+class PageStateView(BaseCartView):
+    """nginx返回的静态页面中和用户有关的数据"""
+
+    def get(self, request):
+        """响应csrf_token和购物车数量;静态详情页带着sku_id请求,登录用户记录浏览信息"""
+        sku_id = parse_sku_id(request.GET.get('sku_id'))
+        if sku_id is not None and request.user.is_authenticated():
+            BrowseHistory(request.user.id).add(sku_id)
+
+        return JsonResponse({'code': 0, 'csrf_token': get_token(request), 'cart_num': self.get_cart_num(request)})
 
-            # 构造上下文
-            context = {
-                'categorys': categorys,
-                'goods_banners': goods_banners,
-                'promotion_banners': promotion_banners,
-            }
 
-            # 缓存上下文: 缓存的key   要缓存的数据   过期的秒数
-            # 说明 : 存储的类型和读取后的类型一致.存进去的是什么,读取的也是什么.但是.存储在redis中时是字符串
-            # context_dict  存-->  string   读-->  context_dict
-            cache.set('index_page_data', context, 3600)
+class IndexView(BaseCartView):
+    """主页"""
+
+    def get(self, request):
+        """查询主页商品数据,渲染模板"""
+
+        # 读取缓存数据 : 缓存失效时只有一个请求查询数据库,快过期时提前重建
+        context = dict(get_index_page_data())
 
         # 查询购物车信息
         cart_num = self.get_cart_num(request)
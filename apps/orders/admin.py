@@ -1,3 +1,53 @@
 from django.contrib import admin
+from django.conf import settings
+from orders.models import OrderInfo
+from utils.db_router import get_order_shard_by_order_id, query_shards
+
 
 # Register your models here.
+
+
+# 后台选择的订单分库 : ?shard=别名 保存在session中,翻页/排序/搜索时继续使用
+ORDER_SHARD_SESSION_KEY = 'admin_order_shard'
+
+
+class OrderInfoAdmin(admin.ModelAdmin):
+    """订单分库之后的订单管理 : 列表页每次查看一个分库,并行查询所有分库的订单数量;修改页根据order_id找到分库"""
+
+    list_display = ['order_id', 'user', 'total_count', 'total_amount', 'pay_method', 'status', 'create_time']
+    list_filter = ['status', 'pay_method']
+    search_fields = ['order_id']
+    # 用户和地址不在订单分库中,不能在分库上校验外键,只允许修改订单状态
+    readonly_fields = ['order_id', 'user', 'address', 'total_count', 'total_amount', 'trans_cost', 'pay_method',
+                       'trade_id']
+
+    def get_shard(self, request):
+        shard = request.session.get(ORDER_SHARD_SESSION_KEY)
+        if shard not in settings.ORDER_SHARDS:
+            shard = settings.ORDER_SHARDS[0]
+        return shard
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(self.get_shard(request))
+
+    def get_object(self, request, object_id, from_field=None):
+        """修改/删除订单 : 订单所在的分库由order_id决定"""
+        try:
+            shard = get_order_shard_by_order_id(object_id)
+        except ValueError:
+            return None
+        return super().get_queryset(request).using(shard).filter(pk=object_id).first()
+
+    def changelist_view(self, request, extra_context=None):
+        # shard参数不是模型的字段,交给ChangeList之前去掉
+        if 'shard' in request.GET:
+            request.GET = request.GET.copy()
+            request.session[ORDER_SHARD_SESSION_KEY] = request.GET.pop('shard')[0]
+
+        counts = query_shards(lambda alias: OrderInfo.objects.using(alias).count())
+        extra_context = dict(extra_context or {}, order_shards=list(zip(settings.ORDER_SHARDS, counts)),
+                             current_shard=self.get_shard(request))
+        return super().changelist_view(request, extra_context)
+
+
+admin.site.register(OrderInfo, OrderInfoAdmin)
@@ -0,0 +1,315 @@
+from django.db import transaction
+from django.db.models import F
+from django.conf import settings
+from django.utils import timezone
+from goods.models import GoodsSKU
+from goods.utils import get_skus_by_ids, parse_sku_id
+from goods.cache import invalidate_list_cache_for_sales
+from orders.models import OrderInfo, OrderGoods
+from orders.stock import StockReservation
+from cart.storage import RedisCart
+from celery_tasks.tasks import sync_sku_stock
+from utils.db_router import get_order_shard
+import json
+
+
+# 异步下单的排队凭证 : commit_ticket_<ticket> = {"user_id":..., "status":..., "message":..., "order_id":...}
+COMMIT_TICKET_KEY = 'commit_ticket_%s'
+# 排队凭证的有效期
+COMMIT_TICKET_EXPIRES = 3600
+
+
+def save_commit_ticket(redis_conn, ticket, user_id, status, message='', order_id=None):
+    """保存异步下单的状态 : status = 'pending' / 'succeeded' / 'failed'"""
+    data = {'user_id': user_id, 'status': status, 'message': message, 'order_id': order_id}
+    redis_conn.setex(COMMIT_TICKET_KEY % ticket, COMMIT_TICKET_EXPIRES, json.dumps(data))
+
+
+def _savepoint(shard):
+    """在主库(库存)和订单分库上各创建一个保存点 : 返回 [(alias, sid), ...],分库就是主库时只创建一个"""
+    return [(alias, transaction.savepoint(using=alias)) for alias in sorted({'default', shard})]
+
+
+def _savepoint_rollback(sids):
+    for alias, sid in sids:
+        transaction.savepoint_rollback(sid, using=alias)
+
+
+def _savepoint_commit(sids):
+    for alias, sid in sids:
+        transaction.savepoint_commit(sid, using=alias)
+
+
+def get_commit_ticket(redis_conn, ticket):
+    """读取异步下单的状态,凭证不存在或已过期时返回None"""
+    data = redis_conn.get(COMMIT_TICKET_KEY % ticket)
+    if data is None:
+        return None
+    return json.loads(data.decode())
+
+
+def create_order(user, address, pay_method, sku_ids, redis_conn=None):
+    """保存数据到OrderInfo和OrderGoods,扣减库存,删除购物车中已下单的商品
+
+    说明 : 提交订单的视图和异步下单的celery任务共用,调用时不能在事务中:
+    redis预扣库存时,同步库存的任务在事务提交之后才发送.
+    返回值和提交订单接口的响应一致 : {'code':..., 'message':...},下单成功时还包含order_id
+    """
+
+    # 一次性读取所有商品的数量 : hmget返回的列表和sku_ids一一对应
+    # 没有传入redis_conn时由RedisCart获取连接,预扣库存使用同一个连接
+    cart = RedisCart(user.id, redis_conn)
+    redis_conn = cart.redis_conn
+    sku_counts = dict(zip(sku_ids, cart.get_counts(sku_ids)))
+
+    # 一次性查询出所有要下单的sku : {sku_id:sku}
+    sku_dict = get_skus_by_ids(sku_ids)
+
+    # 使用:20171222031955
+    order_id = timezone.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+
+    # 订单保存在用户所在的分库 : 分库不是主库时,分库上也需要事务
+    shard = get_order_shard(user.id)
+    with transaction.atomic(), transaction.atomic(using=shard):
+        if settings.ORDER_STOCK_MODE == 'redis':
+            # redis预扣库存:不再使用乐观锁重试
+            result = _commit_with_redis_stock(shard, user, address, pay_method, order_id, sku_ids, sku_counts,
+                                              sku_dict, redis_conn)
+        elif settings.ORDER_STOCK_MODE == 'conditional':
+            # 条件更新扣减库存:一条UPDATE完成库存判断和扣减,不再使用乐观锁重试
+            result = _commit_with_conditional_update(shard, user, address, pay_method, order_id, sku_ids,
+                                                     sku_counts, sku_dict)
+        else:
+            result = _commit_with_optimistic_lock(shard, user, address, pay_method, order_id, sku_ids, sku_counts,
+                                                  sku_dict)
+
+    if result['code'] == 0:
+        # 订单生成后删除购物车 : 同时修改总数量
+        cart.delete(*sku_ids)
+        result['order_id'] = order_id
+
+        if settings.ORDER_STOCK_MODE == 'redis':
+            # 事务已经提交,异步把预扣的库存同步到mysql的stock和sales : 在事务中发送时,
+            # 任务可能在提交之前执行,或者事务回滚之后仍然执行,扣减不存在的订单的库存
+            lines, error = _get_order_lines(sku_ids, sku_counts, sku_dict)
+            sync_sku_stock.delay([[sku.id, count] for sku, count in lines])
+        else:
+            # 销量变化,列表页缓存失效 : redis预扣库存时,在同步库存的任务中处理
+            invalidate_list_cache_for_sales(sku.category_id for sku in sku_dict.values())
+
+    return result
+
+
+def _get_order_lines(sku_ids, sku_counts, sku_dict):
+    """整理订单商品 : 返回 (lines, error), lines = [(sku, count), ...]"""
+    lines = []
+    for sku_id in sku_ids:
+        # 不合法的sku_id(例如 '1,a' 或者末尾多了逗号)和不存在的商品一样处理
+        sku = sku_dict.get(parse_sku_id(sku_id))
+        if sku is None:
+            return None, {'code': 5, 'message': '商品不存在'}
+        try:
+            sku_count = int(sku_counts[sku_id])
+        except (TypeError, ValueError):
+            return None, {'code': 7, 'message': '下单失败,购物车数据错误'}
+        lines.append((sku, sku_count))
+    return lines, None
+
+
+def _commit_with_optimistic_lock(shard, user, address, pay_method, order_id, sku_ids, sku_counts, sku_dict):
+    """乐观锁下单 : 库存没有被别人修改时才扣减,被修改了就重试,最多3次"""
+
+    # 定义临时变量
+    total_count = 0
+    total_sku_amount = 0
+
+    # 在操作数据库之前,创建事务的保存点
+    sid = _savepoint(shard)
+
+    # 暴力回滚
+    try:
+
+        # 创建OrderInfo
+        order = OrderInfo.objects.using(shard).create(
+            order_id = order_id,
+            user = user,
+            address = address,
+            total_amount = 0,
+            trans_cost = 10,
+            pay_method = pay_method
+        )
+
+        # 遍历sku_ids = [1,2,3,...]
+        for sku_id in sku_ids:
+
+            for i in range(3): # 0 1 2
+
+
+                # 取出sku，判断商品是否存在 : 第一次使用批量查询的结果,乐观锁重试时需要重新读取最新的库存
+                if i == 0:
+                    sku = sku_dict.get(parse_sku_id(sku_id))
+                else:
+                    sku = GoodsSKU.objects.filter(id=sku_id).first()
+                if sku is None:
+                    # 异常,回滚
+                    _savepoint_rollback(sid)
+                    return {'code': 5, 'message': '商品不存在'}
+
+                # 获取商品数量，判断库存 (redis)
+                sku_count = sku_counts[sku_id]
+                sku_count = int(sku_count)
+
+                if sku_count > sku.stock:
+                    # 异常,回滚
+                    _savepoint_rollback(sid)
+                    return {'code': 6, 'message': '库存不足'}
+
+                # 计算小计
+                amount = sku_count * sku.price
+
+                # 减少sku库存
+                #sku.stock -= sku_count
+                # 增加sku销量
+                #sku.sales += sku_count
+                #sku.save()
+
+                # 模拟延迟
+                # import time
+                # time.sleep(10)
+
+                # 使用乐观锁,下单,保证库存的安全和正确
+                origin_stock = sku.stock
+                new_stock = origin_stock - sku_count
+                new_sales = sku_count + sku.sales
+
+                result = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
+                if 0 == result and i < 2:
+                    continue
+                elif 0 ==result and i == 2:
+                    # 异常,回滚
+                    _savepoint_rollback(sid)
+                    return {'code': 8, 'message': '下单失败,库存不足,乐观锁'}
+
+                # 保存订单商品数据OrderGoods(能执行到这里说明无异常)
+                # 先创建商品订单信息
+                OrderGoods.objects.using(shard).create(
+                    order = order,
+                    sku = sku,
+                    count = sku_count,
+                    price = sku.price
+                )
+
+                # 计算总数和总金额
+                total_count += sku_count
+                total_sku_amount += amount
+
+                # 只要成功就break
+                break
+
+        # 修改订单信息里面的总数和总金额(OrderInfo)
+        order.total_count = total_count
+        order.total_amount = total_sku_amount + 10
+        order.save()
+
+    except Exception:
+        # 异常,回滚
+        _savepoint_rollback(sid)
+        return {'code':7, 'message':'下单失败,暴力回滚'}
+
+    # 没有异常,提交事务
+    _savepoint_commit(sid)
+
+    return {'code':0, 'message':'提交订单成功'}
+
+
+def _commit_with_conditional_update(shard, user, address, pay_method, order_id, sku_ids, sku_counts, sku_dict):
+    """条件更新下单 : 每个商品一条 UPDATE ... SET stock=stock-n, sales=sales+n WHERE id=? AND stock>=n
+
+    说明 : 库存的判断和扣减在同一条sql中完成,由mysql的行锁保证不会超卖,所以不需要乐观锁重试.
+    订单商品在所有商品扣减成功之后,使用bulk_create一次性写入.
+    """
+
+    lines, error = _get_order_lines(sku_ids, sku_counts, sku_dict)
+    if error is not None:
+        return error
+
+    # 按照sku.id的顺序加行锁 : 同时下单的两个订单包含相同的商品时,加锁顺序一致,不会互相等待造成死锁
+    lines.sort(key=lambda line: line[0].id)
+
+    # 在操作数据库之前,创建事务的保存点
+    sid = _savepoint(shard)
+    try:
+        order = OrderInfo.objects.using(shard).create(
+            order_id = order_id,
+            user = user,
+            address = address,
+            total_count = sum(count for sku, count in lines),
+            total_amount = sum(count * sku.price for sku, count in lines) + 10,
+            trans_cost = 10,
+            pay_method = pay_method
+        )
+
+        for sku, sku_count in lines:
+            result = GoodsSKU.objects.filter(id=sku.id, stock__gte=sku_count).update(
+                stock=F('stock') - sku_count, sales=F('sales') + sku_count)
+            if 0 == result:
+                # 库存不足,回滚
+                _savepoint_rollback(sid)
+                return {'code': 6, 'message': '库存不足'}
+
+        # 所有商品扣减成功,一次性写入订单商品
+        OrderGoods.objects.using(shard).bulk_create([
+            OrderGoods(order=order, sku=sku, count=sku_count, price=sku.price)
+            for sku, sku_count in lines
+        ])
+    except Exception:
+        # 异常,回滚
+        _savepoint_rollback(sid)
+        return {'code': 7, 'message': '下单失败,暴力回滚'}
+
+    _savepoint_commit(sid)
+
+    return {'code': 0, 'message': '提交订单成功'}
+
+
+def _commit_with_redis_stock(shard, user, address, pay_method, order_id, sku_ids, sku_counts, sku_dict, redis_conn):
+    """redis预扣库存下单 : 库存在redis中用lua脚本一次性原子扣减,mysql中的库存和销量由celery异步同步"""
+
+    lines, error = _get_order_lines(sku_ids, sku_counts, sku_dict)
+    if error is not None:
+        return error
+
+    # 预扣库存 : 所有商品要么全部扣减成功,要么全部不扣减
+    reservation = StockReservation(redis_conn)
+    if reservation.reserve(lines) is not None:
+        return {'code': 6, 'message': '库存不足'}
+
+    # 在操作数据库之前,创建事务的保存点
+    sid = _savepoint(shard)
+    try:
+        order = OrderInfo.objects.using(shard).create(
+            order_id = order_id,
+            user = user,
+            address = address,
+            total_count = sum(count for sku, count in lines),
+            total_amount = sum(count * sku.price for sku, count in lines) + 10,
+            trans_cost = 10,
+            pay_method = pay_method
+        )
+
+        for sku, sku_count in lines:
+            OrderGoods.objects.using(shard).create(
+                order = order,
+                sku = sku,
+                count = sku_count,
+                price = sku.price
+            )
+    except Exception:
+        # 异常,回滚,并归还预扣的库存
+        _savepoint_rollback(sid)
+        reservation.release(lines)
+        return {'code': 7, 'message': '下单失败,暴力回滚'}
+
+    _savepoint_commit(sid)
+
+    return {'code': 0, 'message': '提交订单成功'}
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderinfo',
+            name='user',
+            field=models.ForeignKey(verbose_name='下单用户', to=settings.AUTH_USER_MODEL, db_constraint=False),
+        ),
+        migrations.AlterField(
+            model_name='orderinfo',
+            name='address',
+            field=models.ForeignKey(verbose_name='收获地址', to='users.Address', db_constraint=False),
+        ),
+        migrations.AlterField(
+            model_name='ordergoods',
+            name='sku',
+            field=models.ForeignKey(verbose_name='订单商品', to='goods.GoodsSKU', db_constraint=False),
+        ),
+    ]
@@ -51,8 +51,9 @@ class OrderInfo(BaseModel):
     )
 
     order_id = models.CharField(max_length=64, primary_key=True, verbose_name="订单号")
-    user = models.ForeignKey(User, verbose_name="下单用户")
-    address = models.ForeignKey(Address, verbose_name="收获地址")
+    # 订单分库 : 用户/地址/商品不在订单所在的库中,不创建外键约束
+    user = models.ForeignKey(User, db_constraint=False, verbose_name="下单用户")
+    address = models.ForeignKey(Address, db_constraint=False, verbose_name="收获地址")
     total_count = models.IntegerField(default=1, verbose_name="商品总数")
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="商品总金额")
     trans_cost = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="运费")
@@ -62,15 +63,23 @@ class OrderInfo(BaseModel):
 
     class Meta:
         db_table = "df_order_info"
+        # 全部订单页面按用户查询,按下单时间倒序分页(游标翻页时用order_id区分同一时间的订单)
+        index_together = [
+            ("user", "create_time", "order_id"),
+        ]
 
 
 class OrderGoods(BaseModel):
     """订单商品"""
     order = models.ForeignKey(OrderInfo, verbose_name="订单")
-    sku = models.ForeignKey(GoodsSKU, verbose_name="订单商品")
+    sku = models.ForeignKey(GoodsSKU, db_constraint=False, verbose_name="订单商品")
     count = models.IntegerField(default=1, verbose_name="数量")
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="单价")
     comment = models.TextField(default="", verbose_name="评价信息")
 
     class Meta:
-        db_table = "df_order_goods"
\ No newline at end of file
+        db_table = "df_order_goods"
+        # 详情页按商品查询最新的评价
+        index_together = [
+            ("sku", "create_time"),
+        ]
@@ -0,0 +1,160 @@
+from django.conf import settings
+from django.core.cache import cache
+from alipay import AliPay
+from orders.models import OrderInfo
+from utils.db_router import get_order_shard_by_order_id
+from collections import OrderedDict
+import threading
+import time
+import os
+
+
+# 订单的支付状态缓存 : pay_status_<order_id> = {'user_id':..., 'status':...}
+PAY_STATUS_KEY = 'pay_status_%s'
+# 查询支付宝的任务锁,同一个订单同时只有一个查询任务
+PAY_POLLER_KEY = 'pay_poller_%s'
+
+# 支付状态
+PAY_STATUS_PAYING = 'paying'  # 等待支付,需要继续查询
+PAY_STATUS_SUCCEEDED = 'succeeded'  # 支付成功
+PAY_STATUS_FAILED = 'failed'  # 支付失败
+PAY_STATUS_TIMEOUT = 'timeout'  # 超过查询期限,仍然没有支付
+
+
+def build_alipay():
+    """创建对接支付宝的对象"""
+    return AliPay(
+        appid=settings.ALIPAY_APPID,
+        app_notify_url=settings.ALIPAY_NOTIFY_URL,  # 默认回调url
+        # 自己生产的私钥
+        app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
+        # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
+        alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
+        sign_type="RSA2",  # RSA 或者 RSA2
+        debug=True  # 默认False 配合沙箱模式使用
+    )
+
+
+# 每个uwsgi进程共用一个对接支付宝的对象,避免每次请求都读取和解析秘钥文件
+_alipay = None
+# 创建_alipay的进程id : fork之后的子进程需要重新创建
+_alipay_pid = None
+_alipay_lock = threading.Lock()
+
+# 签名之后的order_string缓存 : {(order_id, total_amount): (过期时间, order_string)}
+_order_strings = OrderedDict()
+_order_strings_lock = threading.Lock()
+
+
+def get_alipay():
+    """获取当前进程共用的对接支付宝的对象,第一次使用时才创建"""
+    global _alipay, _alipay_pid
+
+    pid = os.getpid()
+    if _alipay is None or _alipay_pid != pid:
+        with _alipay_lock:
+            if _alipay is None or _alipay_pid != pid:
+                _alipay = build_alipay()
+                _alipay_pid = pid
+    return _alipay
+
+
+def get_order_string(order_id, total_amount):
+    """生成电脑网站支付的order_string : 签名结果按 (order_id, total_amount) 缓存ALIPAY_ORDER_STRING_TTL秒
+
+    说明 : 缓存在当前进程内,重复点击支付时不再重新签名
+    """
+    key = (order_id, total_amount)
+    now = time.time()
+
+    with _order_strings_lock:
+        cached = _order_strings.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    order_string = get_alipay().api_alipay_trade_page_pay(
+        out_trade_no=order_id,
+        total_amount=total_amount,
+        subject='天天生鲜',
+        return_url=None,
+        notify_url=None  # 可选, 不填则使用默认notify url
+    )
+
+    with _order_strings_lock:
+        _order_strings[key] = (now + settings.ALIPAY_ORDER_STRING_TTL, order_string)
+        _order_strings.move_to_end(key)
+        # 超过最大数量时,删除最早缓存的
+        while len(_order_strings) > settings.ALIPAY_ORDER_STRING_MAX_SIZE:
+            _order_strings.popitem(last=False)
+
+    return order_string
+
+
+def get_pay_status(order_id):
+    """读取缓存的支付状态,没有缓存时返回None"""
+    return cache.get(PAY_STATUS_KEY % order_id)
+
+
+def save_pay_status(order_id, user_id, status):
+    """缓存支付状态 : 缓存时间比查询期限长,保证查询任务结束之后还能读到最终状态"""
+    data = {'user_id': user_id, 'status': status}
+    cache.set(PAY_STATUS_KEY % order_id, data, settings.ALIPAY_QUERY_DEADLINE * 2)
+
+
+def acquire_poller(order_id):
+    """抢占查询任务锁 : cache.add()只在key不存在时写入,抢到锁才需要启动查询任务"""
+    return cache.add(PAY_POLLER_KEY % order_id, 1, settings.ALIPAY_QUERY_DEADLINE)
+
+
+def release_poller(order_id):
+    """释放查询任务锁"""
+    cache.delete(PAY_POLLER_KEY % order_id)
+
+
+def next_poll_delay(attempt):
+    """第attempt次查询前等待的秒数 : 指数退避,不超过最大间隔"""
+    delay = settings.ALIPAY_QUERY_INITIAL_DELAY * (2 ** attempt)
+    return min(delay, settings.ALIPAY_QUERY_MAX_DELAY)
+
+
+def mark_order_paid(order_id, user_id, trade_id):
+    """支付成功:保存支付宝维护的订单id,修改订单的状态为待评价
+
+    说明 : 只修改待支付的订单,查询任务和支付宝异步通知重复修改时不会出错
+    """
+    OrderInfo.objects.using(get_order_shard_by_order_id(order_id)).filter(
+        order_id=order_id, status=OrderInfo.ORDER_STATUS_ENUM['UNPAID']).update(
+        trade_id=trade_id, status=OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'])
+    save_pay_status(order_id, user_id, PAY_STATUS_SUCCEEDED)
+
+
+def check_trade(order_id, user_id, gateway=None):
+    """调用一次支付宝查询接口,更新订单和支付状态缓存,返回支付状态
+
+    gateway : 对接支付宝的对象,默认使用当前进程共用的get_alipay(),测试时可以传入本地的假网关
+    """
+    if gateway is None:
+        gateway = get_alipay()
+
+    # 调用查询接口
+    # 参数:可以接受商家维护的订单id.可以接受支付宝维护的订单id
+    # 返回值:是个字典,内部包含了支付宝响应给调用者的参数信息,包括code,trade_status,trade_no
+    response = gateway.api_alipay_trade_query(order_id)
+
+    # 读取code,trade_status
+    code = response.get('code')
+    trade_status = response.get('trade_status')
+
+    # 判断订单状态
+    if code == '10000' and trade_status == 'TRADE_SUCCESS':
+        # 支付成功
+        mark_order_paid(order_id, user_id, response.get('trade_no'))
+        return PAY_STATUS_SUCCEEDED
+    elif code == '40004' or (code == '10000' and trade_status == 'WAIT_BUYER_PAY'):
+        # 有待商量,需要继续查询
+        save_pay_status(order_id, user_id, PAY_STATUS_PAYING)
+        return PAY_STATUS_PAYING
+    else:
+        # 支付失败
+        save_pay_status(order_id, user_id, PAY_STATUS_FAILED)
+        return PAY_STATUS_FAILED
@@ -0,0 +1,96 @@
+from utils.redis_store import RedisRepository
+from django.db.models import F
+from goods.models import GoodsSKU
+from collections import OrderedDict
+
+
+# redis中镜像的sku库存 : stock_<sku_id> = 剩余库存
+STOCK_KEY = 'stock_%s'
+
+
+# 预扣库存 : KEYS = [stock_<sku_id>, ...]  ARGV = [count, ...]
+# 先检查全部商品,再全部扣减,一个订单的商品要么全部扣减成功,要么全部不扣减
+# 返回值 : 0 成功;  i 第i个商品库存不足;  -i 第i个商品的库存还没有加载到redis
+RESERVE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local stock = redis.call('get', key)
+    if not stock then
+        return -i
+    end
+    if tonumber(stock) < tonumber(ARGV[i]) then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('decrby', key, ARGV[i])
+end
+return 0
+"""
+
+# 归还库存 : 只归还已经加载到redis中的库存
+RELEASE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        redis.call('incrby', key, ARGV[i])
+    end
+end
+return 0
+"""
+
+
+def _group_lines(lines):
+    """按照商品合并数量 : 同一个商品出现多次时,需要用总数量判断库存,返回 [(sku, count), ...]"""
+    grouped = OrderedDict()
+    for sku, count in lines:
+        if sku.id in grouped:
+            grouped[sku.id][1] += count
+        else:
+            grouped[sku.id] = [sku, count]
+    return [(sku, count) for sku, count in grouped.values()]
+
+
+class StockReservation(RedisRepository):
+    """redis预扣库存:库存镜像在redis中,下单时用lua脚本原子扣减,再由celery异步同步到mysql
+
+    说明 : redis中的库存才是下单时的准确库存,mysql中的库存会在同步任务执行后追上.
+    所以stock_<sku_id>不设置过期时间,后台修改库存时(GoodsSKUAdmin)调用adjust()同时修改两边.
+    """
+
+    def load(self, skus):
+        """把mysql中的库存加载到redis,已经加载过的不覆盖"""
+        with self.pipeline() as pipeline:
+            for sku in skus:
+                pipeline.set(STOCK_KEY % sku.id, sku.stock, nx=True)
+
+    def reserve(self, lines):
+        """预扣库存 : lines = [(sku, count), ...]
+
+        返回值 : None 扣减成功, 否则返回库存不足的sku
+        """
+        # 脚本中每个key单独和库存比较,同一个商品的多行需要先合并,否则每行都能通过检查,超卖
+        lines = _group_lines(lines)
+        keys = [STOCK_KEY % sku.id for sku, count in lines]
+        args = [count for sku, count in lines]
+
+        result = self.run_script(RESERVE_SCRIPT, keys, args)
+        if result < 0:
+            # 有商品的库存还没有加载到redis,加载之后再扣减一次
+            self.load([sku for sku, count in lines])
+            result = self.run_script(RESERVE_SCRIPT, keys, args)
+
+        if result > 0:
+            return lines[result - 1][0]
+        return None
+
+    def release(self, lines):
+        """归还库存 : 下单失败时,把预扣的库存加回去"""
+        lines = _group_lines(lines)
+        keys = [STOCK_KEY % sku.id for sku, count in lines]
+        args = [count for sku, count in lines]
+        self.run_script(RELEASE_SCRIPT, keys, args)
+
+    def adjust(self, sku_id, delta):
+        """运营修改库存 : 同时修改mysql和redis中的库存"""
+        GoodsSKU.objects.filter(id=sku_id).update(stock=F('stock') + delta)
+        self.run_script(RELEASE_SCRIPT, [STOCK_KEY % sku_id], [delta])
+
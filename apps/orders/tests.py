@@ -1,3 +1,363 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
+from django.http import HttpResponse
+from django.core.urlresolvers import reverse
+from users.models import User, Address
+from orders.models import OrderInfo, OrderGoods
+from goods.models import GoodsCategory, Goods, GoodsSKU
+from orders.pay import check_trade, get_pay_status, next_poll_delay, \
+    PAY_STATUS_PAYING, PAY_STATUS_SUCCEEDED, PAY_STATUS_FAILED
+from orders.commit import create_order
+from orders.stock import RESERVE_SCRIPT, RELEASE_SCRIPT, STOCK_KEY
+from cart.storage import DELETE_SCRIPT, CART_KEY, CART_TOTAL_KEY
+from unittest import mock
+from utils import db_router
 
 # Create your tests here.
+
+
+class FakeGateway(object):
+    """本地的假支付宝网关:按顺序返回预先设置好的查询结果"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.queries = []
+
+    def api_alipay_trade_query(self, out_trade_no=None, trade_no=None):
+        self.queries.append(out_trade_no)
+        return self.responses.pop(0)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ALIPAY_QUERY_INITIAL_DELAY=2,
+    ALIPAY_QUERY_MAX_DELAY=30,
+    ALIPAY_QUERY_DEADLINE=900,
+)
+class CheckTradeTest(TestCase):
+    """查询支付宝订单状态"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('allen', 'allen@example.com', 'pwd')
+        address = Address.objects.create(user=self.user, receiver_name='allen', receiver_mobile='13800000000',
+                                         detail_addr='北京', zip_code='100000')
+        self.order = OrderInfo.objects.create(order_id='20180227033455%s' % self.user.id, user=self.user,
+                                              address=address, total_amount=20, trans_cost=10,
+                                              pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+
+    def test_wait_then_success(self):
+        gateway = FakeGateway(
+            {'code': '10000', 'trade_status': 'WAIT_BUYER_PAY'},
+            {'code': '10000', 'trade_status': 'TRADE_SUCCESS', 'trade_no': '2018022721001004070200176844'},
+        )
+
+        status = check_trade(self.order.order_id, self.user.id, gateway)
+        self.assertEqual(status, PAY_STATUS_PAYING)
+        self.assertEqual(get_pay_status(self.order.order_id)['status'], PAY_STATUS_PAYING)
+
+        status = check_trade(self.order.order_id, self.user.id, gateway)
+        self.assertEqual(status, PAY_STATUS_SUCCEEDED)
+        self.assertEqual(get_pay_status(self.order.order_id)['status'], PAY_STATUS_SUCCEEDED)
+
+        order = OrderInfo.objects.get(order_id=self.order.order_id)
+        self.assertEqual(order.status, OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'])
+        self.assertEqual(order.trade_id, '2018022721001004070200176844')
+        self.assertEqual(gateway.queries, [self.order.order_id, self.order.order_id])
+
+    def test_trade_not_exist_keeps_waiting(self):
+        gateway = FakeGateway({'code': '40004'})
+        self.assertEqual(check_trade(self.order.order_id, self.user.id, gateway), PAY_STATUS_PAYING)
+
+    def test_failed(self):
+        gateway = FakeGateway({'code': '10000', 'trade_status': 'TRADE_CLOSED'})
+
+        self.assertEqual(check_trade(self.order.order_id, self.user.id, gateway), PAY_STATUS_FAILED)
+        order = OrderInfo.objects.get(order_id=self.order.order_id)
+        self.assertEqual(order.status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    def test_poll_delay_backoff(self):
+        self.assertEqual([next_poll_delay(i) for i in range(6)], [2, 4, 8, 16, 30, 30])
+
+
+@override_settings(ALIPAY_APPID='2016082100308405')
+class AlipayNotifyTest(TestCase):
+    """支付宝异步通知"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('allen', 'allen@example.com', 'pwd')
+        address = Address.objects.create(user=self.user, receiver_name='allen', receiver_mobile='13800000000',
+                                         detail_addr='北京', zip_code='100000')
+        self.order = OrderInfo.objects.create(order_id='20180227033455%s' % self.user.id, user=self.user,
+                                              address=address, total_amount=20, trans_cost=10,
+                                              pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+
+    def notify(self, **data):
+        """发送签名正确的通知,返回 (响应内容, mark_order_paid的mock)"""
+        params = {'sign': 'sign', 'trade_status': 'TRADE_SUCCESS', 'out_trade_no': self.order.order_id,
+                  'trade_no': '2018022721001004070200176844', 'app_id': '2016082100308405', 'total_amount': '20.00'}
+        params.update(data)
+        with mock.patch('orders.views.get_alipay') as get_alipay, \
+                mock.patch('orders.views.mark_order_paid') as mark_order_paid:
+            get_alipay.return_value.verify.return_value = True
+            response = self.client.post(reverse('orders:alipay_notify'), params)
+        return response.content, mark_order_paid
+
+    def test_success(self):
+        content, mark_order_paid = self.notify()
+        self.assertEqual(content, b'success')
+        mark_order_paid.assert_called_once_with(self.order.order_id, self.user.id, '2018022721001004070200176844')
+
+    def test_amount_mismatch(self):
+        content, mark_order_paid = self.notify(total_amount='0.01')
+        self.assertEqual(content, b'failure')
+        self.assertFalse(mark_order_paid.called)
+
+    def test_app_id_mismatch(self):
+        content, mark_order_paid = self.notify(app_id='2016000000000000')
+        self.assertEqual(content, b'failure')
+        self.assertFalse(mark_order_paid.called)
+
+
+class FakePipeline(object):
+    """假redis的pipeline : 记录命令,execute()时依次执行"""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis_conn, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeRedis(object):
+    """本地的假redis : 只实现下单用到的命令,lua脚本用对应的python函数代替"""
+
+    def __init__(self):
+        self.data = {}
+        self.scripts = {RESERVE_SCRIPT: self.reserve, RELEASE_SCRIPT: self.release, DELETE_SCRIPT: self.delete_cart}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value).encode()
+        return True
+
+    def hmget(self, key, *fields):
+        cart = self.data.get(key, {})
+        return [cart.get(str(field).encode()) for field in fields]
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        return lambda keys, args: self.scripts[script](keys, args)
+
+    def reserve(self, keys, args):
+        for i, key in enumerate(keys, 1):
+            if key not in self.data:
+                return -i
+            if int(self.data[key]) < int(args[i - 1]):
+                return i
+        for key, count in zip(keys, args):
+            self.data[key] = str(int(self.data[key]) - int(count)).encode()
+        return 0
+
+    def release(self, keys, args):
+        for key, count in zip(keys, args):
+            if key in self.data:
+                self.data[key] = str(int(self.data[key]) + int(count)).encode()
+        return 0
+
+    def delete_cart(self, keys, args):
+        cart = self.data.setdefault(keys[0], {})
+        total = int(self.data.get(keys[1], 0))
+        for sku_id in args:
+            total -= int(cart.pop(str(sku_id).encode(), 0))
+        self.data[keys[1]] = str(total).encode()
+        return total
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ORDER_STOCK_MODE='redis',
+    ORDER_SHARDS=['default'],
+)
+class RedisStockCommitTest(TestCase):
+    """redis预扣库存下单"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('allen', 'allen@example.com', 'pwd')
+        self.address = Address.objects.create(user=self.user, receiver_name='allen', receiver_mobile='13800000000',
+                                              detail_addr='北京', zip_code='100000')
+        category = GoodsCategory.objects.create(name='新鲜水果', logo='fruit', image='category/fruit.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.sku = GoodsSKU.objects.create(category=category, goods=goods, name='草莓', title='草莓', unit='500g',
+                                           price=10, stock=5, default_image='goods/strawberry.jpg')
+        self.redis_conn = FakeRedis()
+
+    def add_to_cart(self, count):
+        self.redis_conn.data[CART_KEY % self.user.id] = {str(self.sku.id).encode(): str(count).encode()}
+        self.redis_conn.data[CART_TOTAL_KEY % self.user.id] = str(count).encode()
+
+    @mock.patch('orders.commit.sync_sku_stock')
+    def test_reserve(self, sync_sku_stock):
+        self.add_to_cart(2)
+        result = create_order(self.user, self.address, 1, [str(self.sku.id)], self.redis_conn)
+
+        self.assertEqual(result['code'], 0)
+        order = OrderInfo.objects.get(order_id=result['order_id'])
+        self.assertEqual(order.total_count, 2)
+        self.assertEqual(order.ordergoods_set.get().count, 2)
+        # redis中的库存已经扣减,mysql中的库存由同步任务扣减
+        self.assertEqual(self.redis_conn.get(STOCK_KEY % self.sku.id), b'3')
+        sync_sku_stock.delay.assert_called_once_with([[self.sku.id, 2]])
+        # 已下单的商品从购物车中删除
+        self.assertEqual(self.redis_conn.hmget(CART_KEY % self.user.id, self.sku.id), [None])
+        self.assertEqual(self.redis_conn.get(CART_TOTAL_KEY % self.user.id), b'0')
+
+    @mock.patch('orders.commit.sync_sku_stock')
+    def test_insufficient_stock(self, sync_sku_stock):
+        self.add_to_cart(6)
+        result = create_order(self.user, self.address, 1, [str(self.sku.id)], self.redis_conn)
+
+        self.assertEqual(result['code'], 6)
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertEqual(self.redis_conn.get(STOCK_KEY % self.sku.id), b'5')
+        self.assertFalse(sync_sku_stock.delay.called)
+
+    @mock.patch('orders.commit.sync_sku_stock')
+    def test_duplicate_sku_id(self, sync_sku_stock):
+        # 同一个商品出现两次 : 每行3件都不超过库存5,合计6件超过库存
+        self.add_to_cart(3)
+        result = create_order(self.user, self.address, 1, [str(self.sku.id), str(self.sku.id)], self.redis_conn)
+
+        self.assertEqual(result['code'], 6)
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertEqual(self.redis_conn.get(STOCK_KEY % self.sku.id), b'5')
+        self.assertFalse(sync_sku_stock.delay.called)
+
+
+@override_settings(
+    DATABASE_REPLICAS={'slave': 1},
+    DATABASE_REPLICA_MAX_LAG=5,
+    DATABASE_REPLICA_CHECK_INTERVAL=5,
+    DATABASE_PIN_SECONDS=10,
+)
+class MasterSlaveDBRouterTest(SimpleTestCase):
+    """读写分离 : 从库健康检查,读己之写"""
+
+    def setUp(self):
+        self.health = {'slave': True}
+        self.checks = []
+        self.replicas = db_router.replicas
+        db_router.replicas = db_router.ReplicaSet(check=self.check)
+        self.router = db_router.MasterSlaveDBRouter()
+        self.middleware = db_router.ReplicaPinMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        db_router.replicas = self.replicas
+
+    def check(self, alias):
+        self.checks.append(alias)
+        return self.health[alias]
+
+    def test_read_replica(self):
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'slave')
+        self.assertEqual(self.router.db_for_write(OrderInfo), 'default')
+        # 检查间隔内不重复检查
+        self.router.db_for_read(OrderInfo)
+        self.assertEqual(self.checks, ['slave'])
+
+    def test_unhealthy_replica_fallback(self):
+        self.health['slave'] = False
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'default')
+
+        # 恢复之后,到了检查时间重新使用
+        self.health['slave'] = True
+        db_router.replicas.checked_at = 0
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'slave')
+
+    def test_weight(self):
+        with self.settings(DATABASE_REPLICAS={'slave': 0}):
+            self.assertEqual(self.router.db_for_read(OrderInfo), 'default')
+
+    def test_read_your_writes(self):
+        # 提交订单 : 写过数据之后,同一个请求读主库,响应中设置cookie
+        request = self.factory.post('/orders/commit')
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'slave')
+        self.router.db_for_write(OrderInfo)
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'default')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertEqual(response.cookies[db_router.PIN_COOKIE]['max-age'], 10)
+
+        # 全部订单 : 带着cookie的请求读主库
+        request = self.factory.get('/orders/1')
+        request.COOKIES[db_router.PIN_COOKIE] = '1'
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'default')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+
+        # 请求结束之后不再固定到主库
+        request = self.factory.get('/orders/1')
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'slave')
+        self.middleware.process_response(request, HttpResponse())
+
+    def test_pin_to_primary(self):
+        # 异步下单成功 : 数据由celery写入,查询状态的请求也需要设置cookie
+        request = self.factory.get('/orders/commit/status')
+        self.middleware.process_request(request)
+        db_router.pin_to_primary()
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'default')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+
+    def test_read_primary(self):
+        with db_router.read_primary():
+            self.assertEqual(self.router.db_for_read(OrderInfo), 'default')
+        self.assertEqual(self.router.db_for_read(OrderInfo), 'slave')
+
+    @override_settings(ORDER_SHARDS=['default', 'shard1'])
+    def test_order_read_shard(self):
+        # 全部订单 : 主库上的订单读从库,写过数据之后读主库;其他分库没有从库
+        self.assertEqual(db_router.get_order_read_shard(2), 'slave')
+        self.assertEqual(db_router.get_order_read_shard(3), 'shard1')
+        with db_router.read_primary():
+            self.assertEqual(db_router.get_order_read_shard(2), 'default')
+
+
+@override_settings(ORDER_SHARDS=['default', 'slave'], DATABASE_REPLICAS={})
+class OrderShardRouterTest(SimpleTestCase):
+    """订单分库 : 根据user_id/order_id找到分库"""
+
+    def setUp(self):
+        self.router = db_router.OrderShardRouter()
+
+    def test_shard_by_order_id(self):
+        self.assertEqual(db_router.get_order_shard(6), 'default')
+        self.assertEqual(db_router.get_order_shard_by_order_id('20180227033455%s' % 7), 'slave')
+        with self.assertRaises(ValueError):
+            db_router.get_order_shard_by_order_id('20180227033455')
+
+    def test_route_instance(self):
+        order = OrderInfo(order_id='20180227033455%s' % 7)
+        self.assertEqual(self.router.db_for_write(OrderInfo, instance=order), 'slave')
+        # 订单商品跟随订单 : 关联查询和新建的订单商品
+        self.assertEqual(self.router.db_for_read(OrderGoods, instance=order), 'slave')
+        self.assertEqual(self.router.db_for_write(OrderGoods, instance=OrderGoods(order_id=order.order_id)), 'slave')
+        # 用户的订单 : user.orderinfo_set
+        self.assertEqual(self.router.db_for_read(OrderInfo, instance=User(id=9)), 'slave')
+        # 其他模型交给读写分离路由
+        self.assertIsNone(self.router.db_for_read(GoodsSKU, instance=order))
+        self.assertIsNone(self.router.db_for_read(OrderInfo))
+
+    def test_query_shards(self):
+        self.assertEqual(db_router.query_shards(lambda alias: alias.upper()), ['DEFAULT', 'SLAVE'])
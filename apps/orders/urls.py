@@ -9,6 +9,9 @@ urlpatterns = [
     # 提交订单 : http://127.0.0.1:8000/orders/commit (需要的sku_id和count存放在post请求体中)
     url(r'^commit$', views.CommitOrderView.as_view(), name='commit'),
 
+    # 异步下单状态 : http://127.0.0.1:8000/orders/commit/status?ticket=xxx
+    url(r'^commit/status$', views.CommitStatusView.as_view(), name='commit_status'),
+
     # 我的全部订单
     url(r'^(?P<page>\d+)$', views.UserOrdersView.as_view(), name='info'),
 
@@ -19,6 +22,9 @@ urlpatterns = [
     # 支付宝查询:http://127.0.0.1:8000/orders/checkpay?order_id="+order_id"
     url(r'^checkpay$', views.CheckPayView.as_view(), name='checkpay'),
 
+    # 支付宝异步通知 : http://127.0.0.1:8000/orders/alipay/notify
+    url(r'^alipay/notify$', views.AlipayNotifyView.as_view(), name='alipay_notify'),
+
     #评价
     url('^comment/(?P<order_id>\d+)$', views.CommentView.as_view(), name="comment"),
 ]
\ No newline at end of file
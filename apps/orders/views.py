@@ -1,15 +1,29 @@
 from django.shortcuts import render, redirect
 from django.views.generic import View
-from utils.views import LoginRequiredMixin, LoginRequiredJSONMixin, TransactionAtomicMixin
+from utils.views import LoginRequiredMixin, LoginRequiredJSONMixin
 from django.core.urlresolvers import reverse
-from goods.models import GoodsSKU
+from goods.utils import get_skus_by_ids
+from goods.comments import CommentStore
+from cart.storage import RedisCart
 from django_redis import get_redis_connection
 from users.models import Address
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from orders.models import OrderInfo, OrderGoods
-from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from datetime import datetime
+from decimal import Decimal
 from django.core.paginator import Paginator, EmptyPage
-from alipay import AliPay
+from orders.commit import create_order, save_commit_ticket, get_commit_ticket
+from orders.pay import get_alipay, get_order_string, get_pay_status, save_pay_status, acquire_poller, next_poll_delay, \
+    mark_order_paid, PAY_STATUS_PAYING, PAY_STATUS_SUCCEEDED, PAY_STATUS_FAILED, PAY_STATUS_TIMEOUT
+from celery_tasks.tasks import commit_order, poll_alipay_trade
+from goods.static_html import DETAIL_PAGE, schedule_pages
+from utils.db_router import pin_to_primary, get_order_read_shard, get_order_shard_by_order_id
+import uuid
+import copy
 from django.conf import settings
 
 
@@ -24,9 +38,9 @@ class CommentView(LoginRequiredMixin, View):
         """提供评论页面"""
         user = request.user
         try:
-            order = OrderInfo.objects.get(order_id=order_id, user=user)
-        except OrderInfo.DoesNotExist:
-            return redirect(reverse("orders:info"))
+            order = OrderInfo.objects.using(get_order_shard_by_order_id(order_id)).get(order_id=order_id, user=user)
+        except (ValueError, OrderInfo.DoesNotExist):
+            return redirect(reverse("orders:info", kwargs={"page": 1}))
 
         order.status_name = OrderInfo.ORDER_STATUS[order.status]
         order.skus = []
@@ -44,36 +58,82 @@ class CommentView(LoginRequiredMixin, View):
         """处理评论内容"""
         user = request.user
         try:
-            order = OrderInfo.objects.get(order_id=order_id, user=user)
-        except OrderInfo.DoesNotExist:
-            return redirect(reverse("orders:info"))
+            order = OrderInfo.objects.using(get_order_shard_by_order_id(order_id)).get(order_id=order_id, user=user)
+        except (ValueError, OrderInfo.DoesNotExist):
+            return redirect(reverse("orders:info", kwargs={"page": 1}))
 
         # 获取评论条数
         total_count = request.POST.get("total_count")
         total_count = int(total_count)
 
+        # 有新评价的商品,重新生成静态详情页
+        pages = []
+
         for i in range(1, total_count + 1):
             sku_id = request.POST.get("sku_%d" % i)
             content = request.POST.get('content_%d' % i, '')
             try:
-                order_goods = OrderGoods.objects.get(order=order, sku_id=sku_id)
+                order_goods = order.ordergoods_set.get(sku_id=sku_id)
             except OrderGoods.DoesNotExist:
                 continue
 
             order_goods.comment = content
             order_goods.save()
 
+            # 评价同时写入redis,详情页直接读取,不再查询订单和用户
+            CommentStore(sku_id).add(user.username, content, order_goods.create_time)
+            if content:
+                pages.append(DETAIL_PAGE % order_goods.sku_id)
+
+        if pages:
+            schedule_pages(pages)
+
         order.status = OrderInfo.ORDER_STATUS_ENUM["FINISHED"]
         order.save()
 
         return redirect(reverse("orders:info", kwargs={"page": 1}))
 
 
+class AlipayNotifyView(View):
+    """支付宝异步通知:支付成功后,支付宝主动回调"""
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        """验证签名,修改订单状态,响应success告诉支付宝不用再通知"""
+
+        data = request.POST.dict()
+        signature = data.pop('sign', None)
+        if not signature or not get_alipay().verify(data, signature):
+            return HttpResponse('failure')
+
+        if data.get('trade_status') in ('TRADE_SUCCESS', 'TRADE_FINISHED'):
+            order_id = data.get('out_trade_no')
+            try:
+                order = OrderInfo.objects.using(get_order_shard_by_order_id(order_id)).filter(order_id=order_id).first()
+            except ValueError:
+                order = None
+            if order is not None:
+                # 通知中的应用和金额需要和订单一致,防止用其他应用或者其他金额的通知修改订单状态
+                try:
+                    total_amount = Decimal(data.get('total_amount'))
+                except (TypeError, ArithmeticError):
+                    return HttpResponse('failure')
+                if data.get('app_id') != settings.ALIPAY_APPID or total_amount != order.total_amount:
+                    return HttpResponse('failure')
+
+                mark_order_paid(order_id, order.user_id, data.get('trade_no'))
+
+        return HttpResponse('success')
+
+
 class CheckPayView(LoginRequiredJSONMixin, View):
-    """对接支付宝查询接口"""
+    """查询订单支付状态"""
 
     def get(self, request):
-        """查询订单状态:保存支付宝返回的支付宝维护的订单id,修改订单的状态为待评价"""
+        """读取支付状态缓存,不再循环调用支付宝查询接口.查询支付宝由celery任务按指数退避完成"""
 
         # 接受订单id
         order_id = request.GET.get('order_id')
@@ -82,52 +142,39 @@ class CheckPayView(LoginRequiredJSONMixin, View):
         if not order_id:
             return JsonResponse({'code':2, 'message':'缺少订单id'})
 
-        # 查询订单信息:订单id正确,是该登录用户的订单,状态是待支付,支付方式是支付宝
-        try:
-            order = OrderInfo.objects.get(order_id=order_id, user=request.user,
-                                          status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'],
-                                          pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
-        except OrderInfo.DoesNotExist:
+        user = request.user
+        data = get_pay_status(order_id)
+        if data is None:
+            # 第一次查询:订单id正确,是该登录用户的订单,支付方式是支付宝
+            try:
+                order = OrderInfo.objects.using(get_order_shard_by_order_id(order_id)).get(
+                    order_id=order_id, user=user, pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+            except (ValueError, OrderInfo.DoesNotExist):
+                return JsonResponse({'code': 3, 'message': '订单不存在'})
+
+            if order.status != OrderInfo.ORDER_STATUS_ENUM['UNPAID']:
+                return JsonResponse({'code': 0, 'message': '支付成功'})
+
+            data = {'user_id': user.id, 'status': PAY_STATUS_PAYING}
+            save_pay_status(order_id, user.id, PAY_STATUS_PAYING)
+        elif data['user_id'] != user.id:
             return JsonResponse({'code': 3, 'message': '订单不存在'})
 
-        # 创建用于支付宝查询的对象
-        alipay = AliPay(
-            appid=settings.ALIPAY_APPID,
-            app_notify_url=None,  # 默认回调url
-            # 自己生产的私钥
-            app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
-            alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True  # 默认False 配合沙箱模式使用
-        )
-
-        # 循环查询,知道成功或者失败
-        while True:
-
-            # 调用查询接口
-            # 参数:可以接受商家维护的订单id.可以接受支付宝维护的订单id
-            # 返回值:是个字典,内部包含了支付宝响应给调用者的参数信息,包括code,trade_status,trade_no
-            response = alipay.api_alipay_trade_query(order_id)
-
-            # 读取code,trade_status
-            code = response.get('code')
-            trade_status = response.get('trade_status')
-
-            # 判断订单状态
-            if code == '10000' and trade_status == 'TRADE_SUCCESS':
-                # 支付成功:保存trade_no,修改订单状态
-                order.trade_id = response.get('trade_no')
-                order.status = OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT']
-                order.save()
-
-                return JsonResponse({'code':0, 'message':'支付成功'})
-            elif code == '40004' or (code == '10000' and trade_status == 'WAIT_BUYER_PAY'):
-                # 有待商量,需要继续查询
-                continue
-            else:
-                # 支付失败
-                return JsonResponse({'code':4, 'message':'支付失败'})
+        status = data['status']
+        if status == PAY_STATUS_SUCCEEDED:
+            # 订单状态由celery任务修改,之后的全部订单页面读主库,避免从库延迟时还显示待支付
+            pin_to_primary()
+            return JsonResponse({'code': 0, 'message': '支付成功'})
+        elif status == PAY_STATUS_TIMEOUT:
+            return JsonResponse({'code': 4, 'message': '支付超时'})
+        elif status == PAY_STATUS_FAILED:
+            return JsonResponse({'code': 4, 'message': '支付失败'})
+
+        # 等待支付:没有查询任务时启动一个,前端稍后再来查询
+        if acquire_poller(order_id):
+            poll_alipay_trade.apply_async((order_id, user.id), countdown=next_poll_delay(0))
+
+        return JsonResponse({'code': 5, 'message': '等待支付'})
 
 
 class PayView(LoginRequiredJSONMixin, View):
@@ -146,32 +193,18 @@ class PayView(LoginRequiredJSONMixin, View):
 
         # 查询订单信息:订单id正确,是该登录用的订单,状态是待支付,支付方式是支付宝
         try:
-            order = OrderInfo.objects.get(order_id=order_id, user=request.user,
-                                          status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'],
-                                          pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
-        except OrderInfo.DoesNotExist:
+            order = OrderInfo.objects.using(get_order_shard_by_order_id(order_id)).get(
+                order_id=order_id, user=request.user, status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'],
+                pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+        except (ValueError, OrderInfo.DoesNotExist):
             return JsonResponse({'code': 3, 'message': '订单不存在'})
 
-        # 创建用于支付宝支付的对象
-        alipay = AliPay(
-            appid=settings.ALIPAY_APPID,
-            app_notify_url=None,  # 默认回调url
-            # 自己生产的私钥
-            app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
-            alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True  # 默认False 配合沙箱模式使用
-        )
+        # 重新支付:清除上一次的支付状态,下一次查询支付状态时重新查询支付宝
+        save_pay_status(order_id, request.user.id, PAY_STATUS_PAYING)
 
         # 电脑网站支付，需要跳转到https://openapi.alipay.com/gateway.do? + order_string
-        order_string = alipay.api_alipay_trade_page_pay(
-            out_trade_no=order_id,
-            total_amount=str(order.total_amount),  # 将浮点数转成字符串
-            subject='天天生鲜',
-            return_url=None,
-            notify_url=None  # 可选, 不填则使用默认notify url
-        )
+        # 短时间内重复点击支付,直接使用缓存的签名结果
+        order_string = get_order_string(order_id, str(order.total_amount))  # 将浮点数转成字符串
 
         # 生成打开支付宝的url
         url = settings.ALIPAY_URL + '?' + order_string
@@ -184,53 +217,138 @@ class PayView(LoginRequiredJSONMixin, View):
 class UserOrdersView(LoginRequiredMixin, View):
     """用户订单页面"""
 
+    # 每页展示的订单数
+    page_size = 2
+
     def get(self, request, page):
         """提供订单信息页面"""
 
         user = request.user
-        # 查询所有订单
-        orders = user.orderinfo_set.all().order_by("-create_time")
-
-        # 遍历所有订单
-        for order in orders:
-            # 给订单动态绑定：订单状态
-            order.status_name = OrderInfo.ORDER_STATUS[order.status]
-            # 给订单动态绑定：支付方式
-            order.pay_method_name = OrderInfo.PAY_METHODS[order.pay_method]
-            order.skus = []
-            # 查询订单中所有商品
-            order_skus = order.ordergoods_set.all()
-            # 遍历订单中所有商品
-            for order_sku in order_skus:
-                sku = order_sku.sku
-                sku.count = order_sku.count
-                sku.amount = sku.price * sku.count
-                order.skus.append(sku)
-
-        # 分页
+        # 查询所有订单 : 只构造查询集,不查询.先分页,再查询当前页的订单商品
+        # 订单在用户所在的分库,商品不在分库中,订单商品不能和商品关联查询,在bind_order_skus中批量查询商品
+        # 分库是主库时按照读写分离读从库,刚下单/支付的请求带着读己之写的cookie读主库
+        orders = OrderInfo.objects.using(get_order_read_shard(user.id)).filter(user_id=user.id).order_by(
+            "-create_time", "-order_id").prefetch_related('ordergoods_set')
+
+        # 游标翻页 : ?cursor=20180227033455000000_2018022703345510, 深分页时不需要 OFFSET 和 COUNT(*)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            try:
+                page_orders = self.get_cursor_page(orders, cursor)
+            except ValueError:
+                return redirect(reverse("orders:info", kwargs={"page": 1}))
+
+            next_cursor = None
+            if len(page_orders) > self.page_size:
+                page_orders = page_orders[:self.page_size]
+                next_cursor = self.make_cursor(page_orders[-1])
+
+            self.bind_order_skus(page_orders)
+
+            context = {
+                "orders": page_orders,
+                "page": None,
+                "page_list": [],
+                "next_cursor": next_cursor,
+            }
+            return render(request, "user_center_order.html", context)
+
+        # 分页 : 数据库中分页,只查询当前页的订单
         page = int(page)
+        paginator = Paginator(orders, self.page_size)
         try:
-            paginator = Paginator(orders, 2)
             page_orders = paginator.page(page)
         except EmptyPage:
             # 如果传入的页数不存在，就默认给第1页
             page_orders = paginator.page(1)
             page = 1
 
+        # 当前页的订单商品和sku在prefetch_related中批量查询
+        self.bind_order_skus(page_orders)
+
         # 页数
         page_list = paginator.page_range
 
+        # 下一页的游标 : 从当前页继续往后翻时使用游标翻页,不需要OFFSET
+        next_cursor = None
+        if page_orders.has_next():
+            next_cursor = self.make_cursor(page_orders[-1])
+
         context = {
             "orders": page_orders,
             "page": page,
             "page_list": page_list,
+            "next_cursor": next_cursor,
         }
 
         return render(request, "user_center_order.html", context)
 
+    def get_cursor_page(self, orders, cursor):
+        """查询游标之后的订单,多查一条用于判断是否有下一页"""
+        create_time, order_id = cursor.split('_', 1)
+        create_time = datetime.strptime(create_time, '%Y%m%d%H%M%S%f')
+        if settings.USE_TZ:
+            create_time = timezone.make_aware(create_time, timezone.utc)
+
+        orders = orders.filter(Q(create_time__lt=create_time) | Q(create_time=create_time, order_id__lt=order_id))
+        return list(orders[:self.page_size + 1])
+
+    def make_cursor(self, order):
+        """使用最后一个订单的create_time和order_id生成游标"""
+        create_time = order.create_time
+        if settings.USE_TZ:
+            create_time = timezone.localtime(create_time, timezone.utc)
+        return '%s_%s' % (create_time.strftime('%Y%m%d%H%M%S%f'), order.order_id)
+
+    def bind_order_skus(self, orders):
+        """给订单动态绑定订单状态,支付方式,订单商品"""
+        # 当前页所有订单的商品 : 一次查询
+        sku_dict = get_skus_by_ids(order_sku.sku_id for order in orders for order_sku in order.ordergoods_set.all())
+        for order in orders:
+            # 给订单动态绑定：订单状态
+            order.status_name = OrderInfo.ORDER_STATUS[order.status]
+            # 给订单动态绑定：支付方式
+            order.pay_method_name = OrderInfo.PAY_METHODS[order.pay_method]
+            order.skus = []
+            # 订单中所有商品 : 已经被prefetch_related查询出来,不会再查询数据库
+            for order_sku in order.ordergoods_set.all():
+                sku = sku_dict.get(order_sku.sku_id)
+                if sku is None:
+                    continue
+                # 同一个商品可能在多个订单中,每个订单使用自己的副本
+                sku = copy.copy(sku)
+                sku.count = order_sku.count
+                sku.amount = sku.price * sku.count
+                order.skus.append(sku)
+
+
+class CommitStatusView(LoginRequiredJSONMixin, View):
+    """查询异步下单的状态"""
+
+    def get(self, request):
+        """接受排队凭证,响应下单状态 : pending 排队中, succeeded 下单成功, failed 下单失败"""
+
+        # 接受排队凭证
+        ticket = request.GET.get('ticket')
+        if not ticket:
+            return JsonResponse({'code': 2, 'message': '缺少排队凭证'})
+
+        # 查询下单状态,只能查询自己的订单
+        redis_conn = get_redis_connection('default')
+        data = get_commit_ticket(redis_conn, ticket)
+        if data is None or data['user_id'] != request.user.id:
+            return JsonResponse({'code': 3, 'message': '排队凭证不存在'})
+
+        if data['status'] == 'succeeded':
+            # 订单由celery任务保存,之后的全部订单页面读主库,避免从库延迟时看不到新订单
+            pin_to_primary()
+
+        return JsonResponse({'code': 0, 'status': data['status'], 'message': data['message'],
+                             'order_id': data['order_id']})
 
-class CommitOrderView(LoginRequiredJSONMixin, TransactionAtomicMixin, View):
-    """提交订单"""
+
+class CommitOrderView(LoginRequiredJSONMixin, View):
+    """提交订单 : create_order自己管理事务,事务提交之后才发送同步库存的任务,视图不能再包在事务中"""
 
     def post(self, request):
         """接受用户提交订单的参数,保存数据到OrderInfo和OrderGoods,渲染全部订单页面"""
@@ -261,115 +379,18 @@ class CommitOrderView(LoginRequiredJSONMixin, TransactionAtomicMixin, View):
         # 操作redis
         redis_conn = get_redis_connection('default')
 
-        # 定义临时变量
-        total_count = 0
-        total_sku_amount = 0
+        # 异步下单 : 只校验参数,把订单交给celery,立即响应排队凭证,前端轮询下单状态
+        if settings.ORDER_COMMIT_ASYNC:
+            ticket = uuid.uuid4().hex
+            save_commit_ticket(redis_conn, ticket, user.id, 'pending', '排队中')
+            commit_order.delay(ticket, user.id, address.id, pay_method, sku_ids)
+            return JsonResponse({'code': 0, 'message': '排队中', 'ticket': ticket})
 
-        # django提供的时间格式化工具
-        from django.utils import timezone
-        # 使用:20171222031955
-        order_id = timezone.now().strftime('%Y%m%d%H%M%S') + str(user.id)
-
-        # 在操作数据库之前,创建事务的保存点
-        sid = transaction.savepoint()
-
-        # 暴力回滚
-        try:
-
-            # 创建OrderInfo
-            order = OrderInfo.objects.create(
-                order_id = order_id,
-                user = user,
-                address = address,
-                total_amount = 0,
-                trans_cost = 10,
-                pay_method = pay_method
-            )
-
-            # 遍历sku_ids = [1,2,3,...]
-            for sku_id in sku_ids:
-
-                for i in range(3): # 0 1 2
-
-
-                    # 循环取出sku，判断商品是否存在
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        # 异常,回滚
-                        transaction.savepoint_rollback(sid)
-                        return JsonResponse({'code': 5, 'message': '商品不存在'})
-
-                    # 获取商品数量，判断库存 (redis)
-                    sku_count = redis_conn.hget('cart_%s' % user.id, sku_id)
-                    sku_count = int(sku_count)
-
-                    if sku_count > sku.stock:
-                        # 异常,回滚
-                        transaction.savepoint_rollback(sid)
-                        return JsonResponse({'code': 6, 'message': '库存不足'})
-
-                    # 计算小计
-                    amount = sku_count * sku.price
-
-                    # 减少sku库存
-                    #sku.stock -= sku_count
-                    # 增加sku销量
-                    #sku.sales += sku_count
-                    #sku.save()
-
-                    # 模拟延迟
-                    # import time
-                    # time.sleep(10)
-
-                    # 使用乐观锁,下单,保证库存的安全和正确
-                    origin_stock = sku.stock
-                    new_stock = origin_stock - sku_count
-                    new_sales = sku_count + sku.sales
-
-                    result = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock, sales=new_sales)
-                    if 0 == result and i < 2:
-                        continue
-                    elif 0 ==result and i == 2:
-                        # 异常,回滚
-                        transaction.savepoint_rollback(sid)
-                        return JsonResponse({'code': 8, 'message': '下单失败,库存不足,乐观锁'})
-
-                    # 保存订单商品数据OrderGoods(能执行到这里说明无异常)
-                    # 先创建商品订单信息
-                    OrderGoods.objects.create(
-                        order = order,
-                        sku = sku,
-                        count = sku_count,
-                        price = sku.price
-                    )
-
-                    # 计算总数和总金额
-                    total_count += sku_count
-                    total_sku_amount += amount
-
-                    # 只要成功就break
-                    break
-
-            # 修改订单信息里面的总数和总金额(OrderInfo)
-            order.total_count = total_count
-            order.total_amount = total_sku_amount + 10
-            order.save()
-
-        except Exception:
-            # 异常,回滚
-            transaction.savepoint_rollback(sid)
-            return JsonResponse({'code':7, 'message':'下单失败,暴力回滚'})
-
-        # 没有异常,提交事务
-        transaction.savepoint_commit(sid)
-
-        # 订单生成后删除购物车(hdel)
-        # redis_conn.hdel('cart_%s' % user.id, 1, 2, 3)
-        redis_conn.hdel('cart_%s' % user.id, *sku_ids)
+        # 保存订单,扣减库存,删除购物车
+        result = create_order(user, address, pay_method, sku_ids, redis_conn)
 
         # 响应结果
-        return JsonResponse({'code':0, 'message':'提交订单成功'})
+        return JsonResponse(result)
 
 
 class PlaceOrderView(LoginRequiredMixin, View):
@@ -388,10 +409,12 @@ class PlaceOrderView(LoginRequiredMixin, View):
             return redirect(reverse('cart:info'))
 
         # 商品的数量从redis中获取
-        redis_conn = get_redis_connection('default')
-        user_id = request.user.id
+        cart = RedisCart(request.user.id)
         # cart_dict 里面的key和value是bytes
-        cart_dict = redis_conn.hgetall('cart_%s' % user_id)
+        cart_dict = cart.get_all()
+
+        # 一次性查询出所有要结算的sku : {sku_id:sku}
+        sku_dict = get_skus_by_ids(sku_ids)
 
         # 定义临时变量
         skus = []
@@ -408,9 +431,8 @@ class PlaceOrderView(LoginRequiredMixin, View):
             for sku_id in sku_ids:
 
                 # 查询商品信息
-                try:
-                    sku = GoodsSKU.objects.get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
+                sku = sku_dict.get(int(sku_id))
+                if sku is None:
                     return redirect(reverse('cart:info'))
 
                 # 得到商品数量 : sku_count 默认是bytes
@@ -436,9 +458,8 @@ class PlaceOrderView(LoginRequiredMixin, View):
             for sku_id in sku_ids:
 
                 # 查询商品sku
-                try:
-                    sku = GoodsSKU.objects.get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
+                sku = sku_dict.get(int(sku_id))
+                if sku is None:
                     return redirect(reverse('goods:index'))
 
                 # 商品的数量从request中获取,并try校验
@@ -466,7 +487,7 @@ class PlaceOrderView(LoginRequiredMixin, View):
                 total_sku_amount += amount
 
                 # 将sku_id和count写入到redis购物车,方便提交订单时,直接从redis中读取,而不会再次判断count的来源
-                redis_conn.hset('cart_%s' % user_id, sku_id, sku_count)
+                cart.set(sku_id, sku_count)
 
         # 计算实付款 = 总金额 + 邮费
         total_amount = total_sku_amount + trans_cost
@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.template import loader
+from goods.utils import get_skus_by_ids, parse_sku_id
+from utils.redis_store import RedisRepository
+import hashlib
+import time
+
+
+# 用户最近浏览的商品 : browse_history_<user_id> = 有序集合 {sku_id: 浏览时间},同一个商品只保存一次
+HISTORY_KEY = 'browse_history_%s'
+# 之前的浏览记录 : history_<user_id> = 列表 [sku_id, ...],最近浏览的在最前面,读取时迁移到有序集合
+LEGACY_HISTORY_KEY = 'history_%s'
+# 最近浏览的html片段 : history_fragment_<sku_ids的md5>,只和商品有关,浏览记录相同的用户共用
+HISTORY_FRAGMENT_KEY = 'history_fragment_%s'
+
+
+# 读取浏览记录 : KEYS = [browse_history_<user_id>, history_<user_id>]  ARGV = [当前时间, 最多保存的条数, 有效期]
+# 之前的列表还存在时先迁移 : 列表中的商品都比有序集合中的早,分数依次减1,迁移后删除列表.返回最近浏览的sku_ids
+READ_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 then
+    local oldest = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+    local score = tonumber(oldest[2] or ARGV[1])
+    for i, sku_id in ipairs(redis.call('lrange', KEYS[2], 0, tonumber(ARGV[2]) - 1)) do
+        if not redis.call('zscore', KEYS[1], sku_id) then
+            redis.call('zadd', KEYS[1], score - i, sku_id)
+        end
+    end
+    redis.call('del', KEYS[2])
+    redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+    redis.call('expire', KEYS[1], ARGV[3])
+end
+return redis.call('zrevrange', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+"""
+
+
+class BrowseHistory(RedisRepository):
+    """用户的浏览记录 : 最多保存USER_HISTORY_MAX条"""
+
+    def __init__(self, user_id, redis_conn=None):
+        super().__init__(redis_conn)
+        self.key = HISTORY_KEY % user_id
+        self.legacy_key = LEGACY_HISTORY_KEY % user_id
+
+    def add(self, sku_id):
+        """记录浏览的商品 : 已经浏览过的只更新时间,超出数量的删除最早浏览的,一次往返"""
+        with self.pipeline() as pipeline:
+            # ZADD的参数在不同版本的redis-py中不一样,直接发送命令
+            pipeline.execute_command('ZADD', self.key, time.time(), sku_id)
+            pipeline.zremrangebyrank(self.key, 0, -settings.USER_HISTORY_MAX - 1)
+            pipeline.expire(self.key, settings.USER_HISTORY_EXPIRES)
+
+    def get_sku_ids(self):
+        """最近浏览的sku_ids : [int, ...],最近浏览的在最前面"""
+        sku_ids = self.run_script(READ_SCRIPT, [self.key, self.legacy_key],
+                                  [time.time(), settings.USER_HISTORY_MAX, settings.USER_HISTORY_EXPIRES])
+        return [parse_sku_id(sku_id) for sku_id in sku_ids]
+
+    def get_skus(self, sku_ids=None):
+        """最近浏览的商品 : 一次查询,已经删除的商品跳过"""
+        if sku_ids is None:
+            sku_ids = self.get_sku_ids()
+        sku_dict = get_skus_by_ids(sku_ids)
+        return [sku_dict[sku_id] for sku_id in sku_ids if sku_id in sku_dict]
+
+    def render_fragment(self):
+        """最近浏览的html片段 : 按照sku_ids缓存USER_HISTORY_FRAGMENT_TIMEOUT秒,命中时不查询mysql,也不渲染模板"""
+        sku_ids = self.get_sku_ids()
+        if not sku_ids:
+            return ''
+
+        key = HISTORY_FRAGMENT_KEY % hashlib.md5(','.join(map(str, sku_ids)).encode()).hexdigest()
+        html = cache.get(key)
+        if html is None:
+            html = loader.get_template('user_center_history.html').render({'sku_list': self.get_skus(sku_ids)})
+            cache.set(key, html, settings.USER_HISTORY_FRAGMENT_TIMEOUT)
+        return html
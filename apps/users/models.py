@@ -26,4 +26,8 @@ class Address(BaseModel):
     zip_code = models.CharField(max_length=6, verbose_name="邮政编码")
 
     class Meta:
-        db_table = "df_address"
\ No newline at end of file
+        db_table = "df_address"
+        # 按用户查询最新的地址(下单/用户中心)
+        index_together = [
+            ("user", "create_time"),
+        ]
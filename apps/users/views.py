@@ -11,9 +11,9 @@ from django.conf import settings
 from itsdangerous import SignatureExpired
 from django.contrib.auth import authenticate, login, logout
 from utils.views import LoginRequiredMixin
-from django_redis import get_redis_connection
-from goods.models import GoodsSKU
-import json
+from goods.utils import get_skus_by_ids
+from cart.storage import RedisCart
+from users.history import BrowseHistory
 
 
 # Create your views here.
@@ -35,23 +35,13 @@ class UserInfoView(LoginRequiredMixin, View):
             # 将来在模板中,判断地址是否为空,如果为空,地址对应的html内容不写
             address = None
 
-        # 查询最近浏览 : 使用django_redis操作redis
-        # 创建一个连接到redis的对象
-        redis_conn = get_redis_connection('default')
-        # 调用对应的方法,查询出redis列表中保存的sku_ids = [2 8 5 3 7]
-        sku_ids = redis_conn.lrange('history_%s' % user.id, 0, 4)
-        # 定义临时列表容器
-        sku_list = []
-        # 遍历sku_ids,取出里面的sku_id
-        for sku_id in sku_ids:
-            # 查询出sku_id对应的GoodsSKU
-            sku = GoodsSKU.objects.get(id=sku_id)
-            sku_list.append(sku)
+        # 查询最近浏览 : 缓存的html片段,一次查询出所有商品,已经删除的商品跳过
+        history_html = BrowseHistory(user.id).render_fragment()
 
         # 构造上下文
         context = {
             'address': address,
-            'sku_list': sku_list,
+            'history_html': history_html,
         }
 
         # 渲染模板
@@ -174,48 +164,17 @@ class LoginView(View):
             request.session.set_expiry(60*60*24*10)  #状态保持10天
 
         #在界面跳转之前，将cookie中的购物车信息合并得到redis
-        cart_json = request.COOKIES.get('cart')
-        if cart_json is not None:
-            cart_dict_cookie = json.loads(cart_json)
-        else:
-            cart_dict_cookie = {}
-
-        #查询redis中的购物车信息
-        redis_conn = get_redis_connection('default')
-        cart_dict_redis = redis_conn.hgetall('cart_%s' % user.id)
-
-        #遍历cart_dict_cookie,取出其中的sku_id和count信息，存储到redis
-        for sku_id, count in cart_dict_cookie.items():
-
-            #将string转bytes
-            #提醒：在做计算和比较时，需要记住类型统一
-            sku_id = sku_id.encode()
-            if sku_id in cart_dict_redis:
-                origin_count = cart_dict_redis[sku_id]
-                count += int(origin_count)
+        cart_dict_cookie = request.cookie_cart.get_all()
 
-                #在这里合并有可能造成库存不足
-                # sku = GoodsSKU.objects.get(id=sku_id)
-                # if count > sku.stock:
-                #     pass
+        #一次查询出cookie中所有商品的库存 : 合并之后的数量不能超过库存,已经不存在的商品不合并
+        sku_dict = get_skus_by_ids(cart_dict_cookie.keys())
+        stocks = {sku_id: sku.stock for sku_id, sku in sku_dict.items()}
 
-            #保存合并的数据到redis
-            cart_dict_redis[sku_id] = count
+        #将cookie中的商品数量累加到redis的购物车 : 一次脚本调用,同时修改总数量
+        RedisCart(user.id).merge(cart_dict_cookie, stocks)
 
-
-        #一次性向redis中新增多条记录
-        if cart_dict_redis:
-            redis_conn.hmset('cart_%s' % user.id, cart_dict_redis)
-
-
-        # 在界面跳转之前，需要判断登录之后跳转的地方，如果有next就跳转到next指向的地方，反之跳转到住主页
-        next = request.GET.get('next')
-        if next is None:
-            # 响应结果：跳转到主页
-            return redirect(reverse('goods:index'))
-        else:
-            # 跳转到next指向的地方
-            return redirect(next)
+        #合并之后清空cookie中的购物车 : CartCookieMiddleware在响应中删除cookie
+        request.cookie_cart.clear()
 
         # 在界面跳转以前,需要判断登录之后跳转的地方.如果有next就跳转到next指向的地方,反之,跳转到主页
         # http://127.0.0.1:8000/users/login?next=/users/info
@@ -223,15 +182,10 @@ class LoginView(View):
         # 登陆成功，根据next参数决定跳转方向
         if next is None:
             # 如果是直接登陆成功，就重定向到首页
-            response = redirect(reverse('goods:index'))
+            return redirect(reverse('goods:index'))
         else:
             # 如果是用户中心重定向到登陆页面，就回到用户中心
-            response = redirect(next)
-
-        #删除cookie
-        response.delete_cookie('cart')
-
-        return response
+            return redirect(next)
 
         # # 响应结果: 跳转到主页
         # return HttpResponse('登入成功')
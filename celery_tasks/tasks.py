@@ -1,9 +1,16 @@
-from celery import Celery
+from celery import Celery, group
 from django.core.mail import send_mail
 from django.conf import settings
-from goods.models import GoodsCategory, Goods, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
-from django.template import loader
-import os
+from goods.models import GoodsSKU
+from django.db import transaction
+from django.db.models import F
+from goods.cache import invalidate_list_cache_for_sales, refresh_detail_page_data, invalidate_list_cache, \
+    invalidate_detail_cache, invalidate_catalogue_cache
+from goods.static_html import INDEX_PAGE, generate_page, next_generations, pop_dirty_pages
+from orders.pay import check_trade, save_pay_status, release_poller, next_poll_delay, \
+    PAY_STATUS_PAYING, PAY_STATUS_TIMEOUT
+from utils.db_router import read_primary
+import time
 
 # 创建Celery客户端/Celery对象
 # 参数1 : 指定任务所在的路径,从包名开始; 参数2 : 指定任务队列(broker),可以作为任务队列的有多种,此处以Redis数据库为例
@@ -24,50 +31,136 @@ def send_active_email(to_email, user_name, token):
     send_mail(subject, body, sender, receiver, html_message=html_body)
 
 
+@app.task(bind=True, max_retries=settings.STOCK_SYNC_MAX_RETRIES, acks_late=True)
+def sync_sku_stock(self, lines):
+    """异步把redis中预扣的库存同步到mysql : lines = [[sku_id, count], ...]
+
+    所有商品在一个事务中修改,失败时整体回滚,按指数退避重试,不会重复扣减;
+    acks_late : worker在执行中退出时任务会重新投递,不会丢失
+    """
+    try:
+        with transaction.atomic():
+            for sku_id, count in lines:
+                GoodsSKU.objects.filter(id=sku_id).update(stock=F('stock') - count, sales=F('sales') + count)
+    except Exception as exc:
+        raise self.retry(exc=exc, countdown=settings.STOCK_SYNC_RETRY_DELAY * 2 ** self.request.retries)
+
+    # 销量变化,列表页缓存失效
+    category_ids = GoodsSKU.objects.filter(id__in=[sku_id for sku_id, count in lines]).values_list('category_id', flat=True)
+    invalidate_list_cache_for_sales(category_ids)
+
+
 @app.task
-def generate_static_index_html():
-    """异步生成静态主页"""
+def commit_order(ticket, user_id, address_id, pay_method, sku_ids):
+    """异步下单 : 保存订单,并把下单结果记录到排队凭证中"""
+
+    # orders.commit中需要使用sync_sku_stock任务,在这里导入,避免循环导入
+    from orders.commit import create_order, save_commit_ticket
+    from users.models import User, Address
+    from django_redis import get_redis_connection
+
+    redis_conn = get_redis_connection('default')
+
+    try:
+        user = User.objects.get(id=user_id)
+        address = Address.objects.get(id=address_id)
+    except (User.DoesNotExist, Address.DoesNotExist):
+        save_commit_ticket(redis_conn, ticket, user_id, 'failed', '地址错误')
+        return
+
+    try:
+        result = create_order(user, address, pay_method, sku_ids, redis_conn)
+    except Exception:
+        save_commit_ticket(redis_conn, ticket, user_id, 'failed', '下单失败')
+        raise
+
+    if result['code'] == 0:
+        save_commit_ticket(redis_conn, ticket, user_id, 'succeeded', result['message'], result['order_id'])
+    else:
+        save_commit_ticket(redis_conn, ticket, user_id, 'failed', result['message'])
+
 
-    #查询商品分类信息
-    categorys = GoodsCategory.objects.all()
+@app.task
+def poll_alipay_trade(order_id, user_id, attempt=0, deadline=None):
+    """异步查询支付宝订单状态 : 等待支付时按指数退避继续查询,超过查询期限后停止"""
+
+    if deadline is None:
+        deadline = time.time() + settings.ALIPAY_QUERY_DEADLINE
+
+    try:
+        status = check_trade(order_id, user_id)
+    except Exception:
+        # 网关异常时当做等待支付,下次继续查询
+        status = PAY_STATUS_PAYING
 
-    #查询图片轮播信息：需求，根据index从小到大排序
-    goods_banners = IndexGoodsBanner.objects.all().order_by('index')
+    if status != PAY_STATUS_PAYING:
+        # 支付成功或失败,查询结束
+        release_poller(order_id)
+        return status
 
-    #查询商品活动信息：需求，根据index从小到大排序
-    promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
+    if time.time() >= deadline:
+        # 超过查询期限,仍然没有支付
+        save_pay_status(order_id, user_id, PAY_STATUS_TIMEOUT)
+        release_poller(order_id)
+        return PAY_STATUS_TIMEOUT
 
-    #查询主页分类商品列表信息
-    for category in categorys:
-        title_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=0)
-        category.title_banners = title_banners
+    # 等待一段时间后继续查询
+    poll_alipay_trade.apply_async((order_id, user_id, attempt + 1, deadline),
+                                  countdown=next_poll_delay(attempt + 1))
+    return status
+
+
+@app.task
+def refresh_detail_cache(sku_id):
+    """后台重建详情页缓存 : 商品刚刚修改过,读主库"""
+    with read_primary():
+        refresh_detail_page_data(sku_id)
 
-        image_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=1)
-        category.image_banners = image_banners
 
+@app.task
+def generate_static_index_html():
+    """异步生成静态主页"""
+    generate_static_pages([INDEX_PAGE])
 
-    #查询购物车信息
-    cart_num = 0
 
-    #构造上下文
-    context = {
-        'categorys': categorys,
-        'goods_banners': goods_banners,
-        'promotion_banners': promotion_banners,
-        'cart_num': cart_num
-    }
+@app.task
+def generate_static_pages(pages):
+    """异步生成静态页面 : 按照STATIC_HTML_CHUNK_SIZE分组,分发给多个celery worker并行生成
 
-    #获取模板
-    template = loader.get_template('static_index.html')
+    说明 : 先递增每个页面的生成代数,同一个页面连续多次请求生成时,只有最后一次会真正生成
+    """
+    if not pages:
+        return
+    pages = next_generations(sorted(set(pages)))
+    size = settings.STATIC_HTML_CHUNK_SIZE
+    group(generate_static_page_chunk.s(pages[i:i + size]) for i in range(0, len(pages), size)).apply_async()
 
-    #渲染模板
-    html_data = template.render(context)
 
-    # 保存模板html_data
-    # 保存到celery服务器上,因为代码在celery服务器运行的
-    # 保存到celery服务器什么地方:随便/但是我会放在celery服务器中static文件夹下
-    path = os.path.join(settings.STATICFILES_DIRS[0], 'index.html')
+@app.task
+def generate_static_page_chunk(pages):
+    """生成一组静态页面 : pages = [[page, generation], ...],一个页面失败不影响其他页面,全部生成之后再抛出异常,由celery记录"""
+    failed = []
+    # 页面数据刚刚修改过,读主库,避免从库延迟时生成旧的页面
+    with read_primary():
+        for page, generation in pages:
+            try:
+                generate_page(page, generation)
+            except Exception:
+                failed.append(page)
+    if failed:
+        raise RuntimeError('静态页面生成失败 : %s' % ', '.join(failed))
 
 
-    with open(path, 'w')as file:
-        file.write(html_data)
\ No newline at end of file
+@app.task
+def flush_static_pages():
+    """防抖窗口结束 : 缓存只失效一次,窗口内所有需要重新生成的页面一起生成"""
+    pages, catalogue_changed = pop_dirty_pages()
+
+    if catalogue_changed:
+        #删除缓存的数据 : 包括每个进程内缓存的商品分类和主页数据
+        invalidate_catalogue_cache()
+        #所有列表页缓存失效,所有详情页缓存变成过期数据
+        invalidate_list_cache()
+        invalidate_detail_cache()
+
+    generate_static_pages(pages)
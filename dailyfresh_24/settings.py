@@ -68,6 +68,14 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # 统计每个请求的redis往返次数和耗时
+    'utils.redis_store.RedisStatsMiddleware',
+    # 解析未登录用户的购物车cookie : request.cookie_cart
+    'cart.cookie.CartCookieMiddleware',
+    # 读写分离的读己之写 : 写过数据的请求之后一段时间内读主库
+    'utils.db_router.ReplicaPinMiddleware',
+    # 统计每个请求等待数据库连接池的时间
+    'utils.db_pool.pool.PoolStatsMiddleware',
 )
 
 ROOT_URLCONF = 'dailyfresh_24.urls'
@@ -96,23 +104,32 @@ WSGI_APPLICATION = 'dailyfresh_24.wsgi.application'
 # https://docs.djangoproject.com/en/1.8/ref/settings/#databases
 
 #更换数据库引擎为Mysql
+# 使用连接池的mysql引擎(utils.db_pool) : 请求结束时连接归还到连接池,不需要每个请求重新建立TCP连接和认证
+# CONN_MAX_AGE保持默认的0,连接在请求之间由同一个进程的线程共用,而不是每个线程各自保持一个
+# POOL : 每个进程的连接池配置,没有配置的使用utils.db_pool.pool.POOL_DEFAULTS
+#     MAX_SIZE 最多连接数(uwsgi每个进程threads=2), TIMEOUT 等待连接的秒数,
+#     RECYCLE 连接创建多少秒之后重建(小于mysql的wait_timeout), PING_INTERVAL 空闲多少秒之后借出前先ping
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': 'utils.db_pool',
         'NAME': 'dailyfresh_24',
         'HOST': '192.168.59.134', # MySQL数据库地址
         'PORT': '3306',
         'USER': 'root',
         'PASSWORD': 'mysql',
+        'POOL': {'MAX_SIZE': 4, 'TIMEOUT': 5, 'RECYCLE': 3600, 'PING_INTERVAL': 30},
     },
-    # 'slave': {
-    #     'ENGINE': 'django.db.backends.mysql',
-    #     'NAME': 'dailyfresh_24',
-    #     'HOST': '192.168.59.134',  # MySQL数据库地址 (从)
-    #     'PORT': '3306',
-    #     'USER': 'root',
-    #     'PASSWORD': 'mysql',
-    # }
+    'slave': {
+        'ENGINE': 'utils.db_pool',
+        'NAME': 'dailyfresh_24',
+        'HOST': '192.168.59.134',  # MySQL数据库地址 (从)
+        'PORT': '3306',
+        'USER': 'root',
+        'PASSWORD': 'mysql',
+        'POOL': {'MAX_SIZE': 4, 'TIMEOUT': 5, 'RECYCLE': 3600, 'PING_INTERVAL': 30},
+        # 测试时不单独创建从库,使用主库的测试数据库
+        'TEST': {'MIRROR': 'default'},
+    }
 }
 
 
@@ -174,10 +191,76 @@ CACHES = {
         "LOCATION": "redis://192.168.59.134:6379/5",
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # 连接池 : 每个uwsgi进程一个,连接用完时等待其他线程归还,而不是报错
+            "CONNECTION_POOL_CLASS": "redis.BlockingConnectionPool",
+            "CONNECTION_POOL_KWARGS": {
+                "max_connections": 8,  # 2个请求线程 + 1个一级缓存订阅线程(一直占用一个连接) + 余量
+                "timeout": 5,  # 等待空闲连接的秒数
+            },
+            # 连接超时秒数 : 不设置读写超时,一级缓存的订阅线程会一直阻塞等待消息
+            "SOCKET_CONNECT_TIMEOUT": 2,
         }
     }
 }
 
+# django_redis的连接工厂 : 统计每个请求的redis往返次数和耗时
+DJANGO_REDIS_CONNECTION_FACTORY = 'utils.redis_store.InstrumentedConnectionFactory'
+# 在响应头中返回redis往返次数和耗时 (X-Redis-Calls, X-Redis-Time)
+REDIS_STATS_HEADER = DEBUG
+# 一个请求的redis往返次数超过这个数量时,记录警告日志
+REDIS_STATS_WARN_CALLS = 10
+
+# 列表页缓存秒数
+GOODS_LIST_CACHE_TIMEOUT = 600
+# 列表页计算页数时使用的商品数量近似值,缓存秒数
+GOODS_LIST_COUNT_TIMEOUT = 300
+# 商品库存/销量变化时,列表页缓存的失效范围
+# 'none' : 不失效,等待缓存过期; 'hot' : 只失效人气排序; 'category' : 失效商品所在分类的全部列表页
+GOODS_LIST_CACHE_SALES_INVALIDATION = 'hot'
+
+# 详情页缓存 : 新鲜期秒数,过期后继续使用旧数据的秒数(期间由后台任务重建),重建锁秒数,没有缓存时等待重建的次数(每次50ms)
+GOODS_DETAIL_CACHE_TIMEOUT = 600
+GOODS_DETAIL_CACHE_STALE = 3600
+GOODS_DETAIL_LOCK_TIMEOUT = 30
+GOODS_DETAIL_WAIT_TIMES = 10
+
+# 主页缓存 : 缓存秒数,提前重建系数(越大越早重建),重建锁秒数,没有缓存时等待重建的次数(每次50ms)
+GOODS_INDEX_CACHE_TIMEOUT = 3600
+GOODS_INDEX_XFETCH_BETA = 1.0
+GOODS_INDEX_LOCK_TIMEOUT = 30
+GOODS_INDEX_WAIT_TIMES = 10
+
+# 商品评价 : redis中每个商品最多保存的评价条数,详情页每页展示的评价条数
+GOODS_COMMENTS_MAX = 300
+GOODS_COMMENTS_PAGE_SIZE = 30
+# 商品评价在redis中的有效期(秒) : 过期后再次读取时从mysql重新加载,很久没有人看的商品不占用redis
+GOODS_COMMENTS_EXPIRES = 7 * 24 * 3600
+
+# 商品分类在redis中缓存的秒数 : 运营修改数据时主动失效
+GOODS_CATEGORYS_CACHE_TIMEOUT = 86400
+
+# 静态页面 : 生成的目录(nginx的root),每个celery任务生成的页面数量,每个页面保留的版本数量(用于回滚),切换版本的锁秒数
+STATIC_HTML_DIR = STATICFILES_DIRS[0]
+STATIC_HTML_CHUNK_SIZE = 20
+STATIC_HTML_KEEP_VERSIONS = 5
+STATIC_HTML_LOCK_TIMEOUT = 10
+# 防抖窗口秒数 : 窗口内admin的多次修改合并成一次缓存失效和一次页面生成
+STATIC_HTML_DEBOUNCE = 5
+
+# 未登录用户的购物车cookie : 最多保存的商品种类数量,有效期秒数(None表示关闭浏览器时失效)
+CART_COOKIE_MAX_ITEMS = 100
+CART_COOKIE_MAX_AGE = None
+
+# 用户最近浏览 : 最多保存的条数,保存秒数(每次浏览时重新计算),用户中心html片段的缓存秒数
+USER_HISTORY_MAX = 5
+USER_HISTORY_EXPIRES = 30 * 24 * 3600
+USER_HISTORY_FRAGMENT_TIMEOUT = 300
+
+# 进程内(一级)缓存 : 每个进程最多缓存的条数,缓存秒数,广播失效消息的redis频道
+L1_CACHE_MAX_SIZE = 1000
+L1_CACHE_TIMEOUT = 60
+L1_CACHE_CHANNEL = 'l1_cache_invalidate'
+
 # Session
 # http://django-redis-chs.readthedocs.io/zh_CN/latest/#session-backend
 
@@ -220,9 +303,46 @@ ALIPAY_APPID = '2016082100308405'
 APP_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/orders/app_private_key.pem')
 ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/orders/alipay_public_key.pem')
 ALIPAY_URL = 'https://openapi.alipaydev.com/gateway.do'
-
-# 配置读写分离
-# DATABASE_ROUTERS = ['utils.db_router.MasterSlaveDBRouter']
+# 支付宝异步通知地址,例如 'http://域名/orders/alipay/notify', None表示不接收异步通知
+ALIPAY_NOTIFY_URL = None
+# 签名之后的支付链接参数(order_string)在进程内缓存的秒数和最大数量
+ALIPAY_ORDER_STRING_TTL = 60
+ALIPAY_ORDER_STRING_MAX_SIZE = 1024
+# 查询支付宝订单状态 : 第一次查询前等待的秒数,之后按指数退避,最大间隔秒数,查询期限秒数
+ALIPAY_QUERY_INITIAL_DELAY = 2
+ALIPAY_QUERY_MAX_DELAY = 30
+ALIPAY_QUERY_DEADLINE = 15 * 60
+
+# 下单时扣减库存的方式
+# 'optimistic' : mysql乐观锁,默认
+# 'conditional' : 每个商品一条 UPDATE ... WHERE stock >= n 条件更新,不重试,订单商品bulk_create
+# 'redis' : redis中用lua脚本原子预扣库存,再由celery异步同步到mysql,适合秒杀/抢购
+ORDER_STOCK_MODE = 'optimistic'
+# redis预扣库存同步到mysql失败时的重试次数,第n次重试之前等待 STOCK_SYNC_RETRY_DELAY * 2^n 秒
+STOCK_SYNC_MAX_RETRIES = 10
+STOCK_SYNC_RETRY_DELAY = 5
+
+# 异步下单 : 提交订单时只校验参数,由celery排队下单,前端使用/orders/commit/status轮询下单状态
+ORDER_COMMIT_ASYNC = False
+
+# 配置订单分库和读写分离 : 订单分库路由需要在读写分离路由之前
+DATABASE_ROUTERS = ['utils.db_router.OrderShardRouter', 'utils.db_router.MasterSlaveDBRouter']
+# 订单分库 : DATABASES中的别名列表,用户的订单保存在 ORDER_SHARDS[user_id % 分库数量]
+# 分库数量确定之后不能再修改,否则已有用户的订单需要迁移到新的分库;新的分库需要先执行 migrate --database=别名
+ORDER_SHARDS = ['default']
+# 从库及权重 : {DATABASES中的别名: 权重},权重为0的从库不使用,为空时所有读操作都使用主库
+DATABASE_REPLICAS = {'slave': 1}
+# 从库复制延迟超过多少秒时不使用,直到恢复
+DATABASE_REPLICA_MAX_LAG = 5
+# 每个进程每隔多少秒检查一次从库的连接和复制延迟
+DATABASE_REPLICA_CHECK_INTERVAL = 5
+# 读己之写 : 写数据的请求之后多少秒内,同一个浏览器的请求都读主库,需要大于从库的正常延迟
+DATABASE_PIN_SECONDS = 10
+
+# 数据库连接池统计 : 开发环境在响应头中返回借出次数和等待时间
+DB_POOL_STATS_HEADER = DEBUG
+# 一个请求等待数据库连接超过多少秒时记录警告日志
+DB_POOL_WARN_WAIT = 0.05
 
 # 收集静态文件目录
 # STATIC_ROOT = '/Users/allen/Desktop/static_24'
\ No newline at end of file
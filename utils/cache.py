@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from collections import OrderedDict
+import threading
+import time
+import os
+
+
+class LocalCache(object):
+    """进程内的LRU缓存 : 最多保存max_size条,每条缓存timeout秒"""
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()  # {key: (过期时间, value)}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.time():
+                del self._data[key]
+                return default
+            # 最近使用的放到最后
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._data[key] = (time.time() + timeout, value)
+            self._data.move_to_end(key)
+            # 超过最大数量时,删除最久没有使用的
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# 每个uwsgi进程一个一级缓存,二级缓存是django_redis的default缓存
+local_cache = LocalCache(settings.L1_CACHE_MAX_SIZE, settings.L1_CACHE_TIMEOUT)
+
+# 订阅失效消息的线程所在的进程id : fork之后的子进程需要重新启动线程
+_subscriber_pid = None
+_subscriber_lock = threading.Lock()
+
+
+def _listen_invalidation():
+    """订阅一级缓存失效消息 : 消息内容是要删除的key, '*' 表示清空"""
+    while True:
+        try:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.L1_CACHE_CHANNEL)
+            # 订阅之前可能错过了失效消息
+            local_cache.clear()
+            for message in pubsub.listen():
+                key = message['data'].decode()
+                if key == '*':
+                    local_cache.clear()
+                else:
+                    local_cache.delete(key)
+        except Exception:
+            # redis连接断开,稍后重新订阅
+            time.sleep(1)
+
+
+def _ensure_subscriber():
+    """第一次使用一级缓存时,启动订阅失效消息的后台线程"""
+    global _subscriber_pid
+
+    pid = os.getpid()
+    if _subscriber_pid == pid:
+        return
+    with _subscriber_lock:
+        if _subscriber_pid == pid:
+            return
+        # fork出来的子进程中,父进程缓存的数据收不到失效消息
+        local_cache.clear()
+        thread = threading.Thread(target=_listen_invalidation, name='l1-cache-invalidation')
+        thread.daemon = True
+        thread.start()
+        _subscriber_pid = pid
+
+
+def l1_get(key, default=None):
+    """读取一级缓存"""
+    _ensure_subscriber()
+    return local_cache.get(key, default)
+
+
+def l1_set(key, value, timeout=None):
+    """写入一级缓存"""
+    _ensure_subscriber()
+    local_cache.set(key, value, timeout)
+
+
+def get_two_tier(key, loader, timeout):
+    """先读一级缓存,再读二级缓存,都没有时调用loader()查询,并写入两级缓存"""
+    value = l1_get(key)
+    if value is not None:
+        return value
+
+    value = cache.get(key)
+    if value is None:
+        value = loader()
+        cache.set(key, value, timeout)
+
+    l1_set(key, value)
+    return value
+
+
+def invalidate_two_tier(*keys):
+    """删除二级缓存,并通知所有进程删除一级缓存"""
+    cache.delete_many(keys)
+    redis_conn = get_redis_connection('default')
+    for key in keys:
+        local_cache.delete(key)
+        redis_conn.publish(settings.L1_CACHE_CHANNEL, key)
@@ -0,0 +1,40 @@
+from django.db.backends.mysql import base as mysql
+from utils.db_pool.pool import get_pool
+
+
+class DatabaseWrapper(mysql.DatabaseWrapper):
+    """使用连接池的mysql数据库引擎 : ENGINE = 'utils.db_pool'
+
+    django在请求结束时关闭连接(CONN_MAX_AGE = 0),这里改成归还到连接池,下一个请求不需要重新建立TCP连接和认证
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_created_at = None
+        self.pool_reused = False
+
+    def get_pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        """从连接池借出连接,连接池中没有可用连接时才创建"""
+        connect = lambda: mysql.DatabaseWrapper.get_new_connection(self, conn_params)
+        connection, self.pool_created_at = self.get_pool().acquire(connect)
+        self.pool_reused = getattr(connection, 'pool_initialized', False)
+        return connection
+
+    def init_connection_state(self):
+        """连接的会话变量只需要在创建时设置一次,重用的连接少一次往返"""
+        if self.pool_reused:
+            return
+        super().init_connection_state()
+        self.connection.pool_initialized = True
+
+    def _close(self):
+        """归还连接 : 还在事务中的连接(异常中断等)直接关闭,不能把未提交的事务借给其他请求"""
+        if self.connection is None:
+            return
+        if self.in_atomic_block or not self.get_autocommit():
+            self.get_pool().discard(self.connection)
+        else:
+            self.get_pool().release(self.connection, self.pool_created_at)
@@ -0,0 +1,194 @@
+from django.conf import settings
+from django.db.backends.mysql.base import Database
+import threading
+import logging
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# 连接池的默认配置,DATABASES中每个别名可以用 'POOL': {...} 覆盖
+POOL_DEFAULTS = {
+    'MAX_SIZE': 4,  # 每个进程最多创建的连接数(包括借出的)
+    'TIMEOUT': 5,  # 连接都借出时最多等待的秒数,超时抛出OperationalError
+    'RECYCLE': 3600,  # 连接创建多少秒之后关闭重建,需要小于mysql的wait_timeout
+    'PING_INTERVAL': 30,  # 连接空闲超过多少秒时,借出之前先ping检查
+}
+
+# 当前线程(uwsgi的一个请求)的连接池统计 : 借出次数,等待的秒数
+_stats = threading.local()
+
+
+def reset_stats():
+    """请求开始时清零"""
+    _stats.checkouts = 0
+    _stats.wait_seconds = 0.0
+
+
+def get_stats():
+    """返回 (借出次数, 等待的秒数)"""
+    return getattr(_stats, 'checkouts', 0), getattr(_stats, 'wait_seconds', 0.0)
+
+
+class ConnectionPool(object):
+    """一个数据库的连接池 : 同一个进程的线程共用,空闲连接后进先出,让多余的连接自然空闲到被回收"""
+
+    def __init__(self, name, max_size, timeout, recycle, ping_interval):
+        self.name = name
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self.idle = []  # [(connection, 创建时间, 归还时间), ...]
+        self.size = 0  # 已经创建的连接数,包括借出的
+        self.cond = threading.Condition()
+        self.stats = {'checkouts': 0, 'created': 0, 'waits': 0, 'wait_seconds': 0.0,
+                      'timeouts': 0, 'recycled': 0, 'broken': 0}
+
+    def acquire(self, connect):
+        """借出一个连接 : 返回 (connection, 创建时间)
+
+        优先使用空闲连接;没有空闲连接并且没有达到MAX_SIZE时调用connect()创建;否则等待其他线程归还
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            with self.cond:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise Database.OperationalError('数据库连接池%s等待超时 : %s个连接都在使用' %
+                                                        (self.name, self.max_size))
+                    waited = True
+                    self.cond.wait(remaining)
+                item = self.idle.pop() if self.idle else None
+                if item is None:
+                    self.size += 1
+
+            # 创建和检查连接都在锁外面,不阻塞其他线程
+            if item is None:
+                try:
+                    connection = connect()
+                except Exception:
+                    self.discard(None)
+                    raise
+                created_at = time.time()
+                with self.cond:
+                    self.stats['created'] += 1
+                break
+
+            connection, created_at, released_at = item
+            if self._check(connection, created_at, released_at):
+                break
+            self.discard(connection)
+
+        wait_seconds = time.time() - start
+        with self.cond:
+            self.stats['checkouts'] += 1
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += wait_seconds
+        _stats.checkouts = getattr(_stats, 'checkouts', 0) + 1
+        _stats.wait_seconds = getattr(_stats, 'wait_seconds', 0.0) + wait_seconds
+        return connection, created_at
+
+    def _check(self, connection, created_at, released_at):
+        """空闲连接是否可以借出 : 没有超过RECYCLE,空闲较久的需要ping成功"""
+        now = time.time()
+        if now - created_at >= self.recycle:
+            with self.cond:
+                self.stats['recycled'] += 1
+            return False
+        if now - released_at >= self.ping_interval:
+            try:
+                connection.ping(False)
+            except Exception:
+                with self.cond:
+                    self.stats['broken'] += 1
+                return False
+        return True
+
+    def release(self, connection, created_at):
+        """归还连接 : 已经断开的连接直接丢弃"""
+        if not getattr(connection, 'open', True):
+            self.discard(connection)
+            return
+        with self.cond:
+            self.idle.append((connection, created_at, time.time()))
+            self.cond.notify()
+
+    def discard(self, connection):
+        """关闭并丢弃连接,空出的位置可以创建新的连接"""
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def get_stats(self):
+        """连接池的统计 : 累计的借出/创建/等待/超时/回收/断开次数,当前的连接数和空闲连接数"""
+        with self.cond:
+            return dict(self.stats, size=self.size, idle=len(self.idle))
+
+
+# 当前进程的连接池 : {(别名, 地址, 端口, 数据库, 用户): ConnectionPool}
+_pools = {}
+# 创建_pools的进程id : fork之后的子进程不能使用父进程的连接,需要重新创建
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict):
+    """获取数据库别名对应的连接池,第一次使用时才创建
+
+    连接池按照连接参数区分 : 例如测试时数据库名改成测试数据库,不会借出连接到原来数据库的连接
+    """
+    global _pools, _pools_pid
+
+    key = (alias, settings_dict['HOST'], settings_dict['PORT'], settings_dict['NAME'], settings_dict['USER'])
+    pid = os.getpid()
+    with _pools_lock:
+        if _pools_pid != pid:
+            # 父进程的连接和子进程共用socket,不能关闭,直接丢弃
+            _pools = {}
+            _pools_pid = pid
+        pool = _pools.get(key)
+        if pool is None:
+            options = dict(POOL_DEFAULTS, **settings_dict.get('POOL', {}))
+            pool = ConnectionPool(alias, options['MAX_SIZE'], options['TIMEOUT'], options['RECYCLE'],
+                                  options['PING_INTERVAL'])
+            _pools[key] = pool
+        return pool
+
+
+def get_pool_stats():
+    """当前进程所有连接池的统计 : {别名: {...}}"""
+    with _pools_lock:
+        pools = list(_pools.values()) if _pools_pid == os.getpid() else []
+    return {pool.name: pool.get_stats() for pool in pools}
+
+
+class PoolStatsMiddleware(object):
+    """统计每个请求从连接池借出连接的次数和等待时间
+
+    DB_POOL_STATS_HEADER为True时,响应头中返回 X-DB-Pool-Checkouts, X-DB-Pool-Wait(毫秒);
+    等待超过DB_POOL_WARN_WAIT秒时记录警告日志,说明连接池的MAX_SIZE小于并发
+    """
+
+    def process_request(self, request):
+        reset_stats()
+
+    def process_response(self, request, response):
+        checkouts, wait_seconds = get_stats()
+        if settings.DB_POOL_STATS_HEADER:
+            response['X-DB-Pool-Checkouts'] = checkouts
+            response['X-DB-Pool-Wait'] = '%.2f' % (wait_seconds * 1000)
+        if wait_seconds > settings.DB_POOL_WARN_WAIT:
+            logger.warning('等待数据库连接%.2fms : %s %s', wait_seconds * 1000, request.path, get_pool_stats())
+        return response
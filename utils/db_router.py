@@ -1,14 +1,235 @@
+from django.conf import settings
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import random
+import time
+
+
+# 读己之写 : 写过数据的请求之后DATABASE_PIN_SECONDS秒内,带着这个cookie的请求都读主库
+PIN_COOKIE = 'db_pin'
+
+# 当前线程(uwsgi的一个请求)的路由状态
+_local = threading.local()
+
+# 订单分库 : 订单和订单商品按照user_id保存在ORDER_SHARDS中的一个数据库
+# order_id = 14位下单时间 + user_id,只有order_id时也能找到订单所在的库
+ORDER_ID_TIME_LENGTH = 14
+# 分库保存的模型 : (app_label, model_name)
+ORDER_SHARD_MODELS = (('orders', 'orderinfo'), ('orders', 'ordergoods'))
+
+
+def check_replica(alias):
+    """检查从库 : 能连接,并且复制延迟不超过DATABASE_REPLICA_MAX_LAG秒"""
+    try:
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor != 'mysql':
+                cursor.execute('SELECT 1')
+                return True
+
+            cursor.execute('SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                # 没有配置复制(例如开发环境直接指向主库)
+                return True
+            status = dict(zip([column[0] for column in cursor.description], row))
+            lag = status.get('Seconds_Behind_Master')
+            # 复制线程停止时延迟是NULL
+            return lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG
+    except DatabaseError:
+        return False
+
+
+class ReplicaSet(object):
+    """从库 : 按照DATABASE_REPLICAS中的权重随机选择,每DATABASE_REPLICA_CHECK_INTERVAL秒检查一次健康状态"""
+
+    def __init__(self, check=check_replica):
+        self.check = check
+        self.health = {}  # {alias: 是否健康},还没有检查过的算健康
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """到了检查时间时,由一个线程检查所有从库,其他线程继续使用上一次的结果"""
+        if time.time() - self.checked_at < settings.DATABASE_REPLICA_CHECK_INTERVAL:
+            return
+        if not self.lock.acquire(False):
+            return
+        try:
+            self.health = {alias: self.check(alias) for alias in settings.DATABASE_REPLICAS}
+            self.checked_at = time.time()
+        finally:
+            self.lock.release()
+
+    def choose(self):
+        """按照权重选择一个健康的从库,没有健康的从库时返回None"""
+        self.refresh()
+        candidates = [(alias, weight) for alias, weight in settings.DATABASE_REPLICAS.items()
+                      if weight > 0 and self.health.get(alias, True)]
+        if not candidates:
+            return None
+
+        point = random.uniform(0, sum(weight for alias, weight in candidates))
+        for alias, weight in candidates:
+            point -= weight
+            if point <= 0:
+                return alias
+        return candidates[-1][0]
+
+
+replicas = ReplicaSet()
+
+
+def pin_to_primary():
+    """当前请求和之后DATABASE_PIN_SECONDS秒内的请求都读主库 : 数据不是在当前请求中写入时使用,例如异步下单"""
+    _local.pinned = True
+    _local.written = True
+
+
+@contextmanager
+def read_primary():
+    """with read_primary(): ... 中的读操作使用主库 : 不在请求中,读取刚刚写入的数据时使用,例如celery任务生成静态页面"""
+    pinned = getattr(_local, 'pinned', False)
+    _local.pinned = True
+    try:
+        yield
+    finally:
+        _local.pinned = pinned
+
+
+def get_order_shard(user_id):
+    """用户的订单所在的数据库 : ORDER_SHARDS[user_id % 分库数量]"""
+    shards = settings.ORDER_SHARDS
+    return shards[int(user_id) % len(shards)]
+
+
+def get_read_db(alias=DEFAULT_DB_ALIAS):
+    """读操作使用的数据库 : 主库按照读写分离的规则选择 (MasterSlaveDBRouter);
+    DATABASE_REPLICAS是主库的从库,其他订单分库没有配置从库,直接读分库
+    """
+    if alias != DEFAULT_DB_ALIAS:
+        return alias
+    if getattr(_local, 'pinned', False) or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return replicas.choose() or DEFAULT_DB_ALIAS
+
+
+def get_order_read_shard(user_id):
+    """读取用户的订单使用的数据库 : 分库是主库时也使用从库,写过数据的请求读主库"""
+    return get_read_db(get_order_shard(user_id))
+
+
+def get_order_shard_by_order_id(order_id):
+    """订单所在的数据库 : 从order_id中取出user_id,order_id不合法时抛出ValueError"""
+    return get_order_shard(str(order_id)[ORDER_ID_TIME_LENGTH:])
+
+
+def query_shards(func, shards=None):
+    """在每个订单分库上并行执行func(alias) : 返回结果的列表,顺序和shards一致,默认是所有分库
+
+    每个分库在单独的线程中查询,线程结束前关闭(归还)这个线程使用的数据库连接
+    """
+    shards = list(settings.ORDER_SHARDS if shards is None else shards)
+    if len(shards) == 1:
+        return [func(shards[0])]
+
+    def run(alias):
+        try:
+            return func(alias)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        return list(executor.map(run, shards))
+
+
+class OrderShardRouter(object):
+    """订单分库路由 : 需要配置在MasterSlaveDBRouter之前
+
+    保存/删除订单,以及通过关联查询(order.ordergoods_set, user.orderinfo_set)读取订单时,根据instance找到分库;
+    其他查询需要用 .using(get_order_shard(...)) 指定分库,否则交给下一个路由,只在只有一个分库时正确
+    """
+
+    def get_shard(self, model, instance):
+        if (model._meta.app_label, model._meta.model_name) not in ORDER_SHARD_MODELS or instance is None:
+            return None
+        if (instance._meta.app_label, instance._meta.model_name) in ORDER_SHARD_MODELS:
+            # 订单/订单商品 : 已经保存过的使用所在的库,新建的根据order_id(订单商品的order_id是外键)
+            if instance._state.db:
+                return instance._state.db
+            return get_order_shard_by_order_id(instance.order_id)
+        if (instance._meta.app_label, instance._meta.model_name) == tuple(settings.AUTH_USER_MODEL.lower().split('.')):
+            # 用户的订单
+            return get_order_shard(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.get_shard(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.get_shard(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        """分库中创建所有的表 : 只使用订单表,其他表只是为了迁移时外键能够创建"""
+        if db in settings.ORDER_SHARDS:
+            return True
+        return None
+
+
 class MasterSlaveDBRouter(object):
-    """读写分离路由"""
+    """读写分离路由
+
+    写 : 主库
+    读 : 按照权重使用健康的从库;以下情况使用主库
+        - 主库在事务中 : 事务中读到的数据需要和写入的一致,例如下单时的乐观锁
+        - 当前请求写过数据,或者带着读己之写的cookie (ReplicaPinMiddleware)
+        - 没有健康的从库
+    """
 
     def db_for_read(self, model, **hints):
         """读"""
-        return 'slave'
+        instance = hints.get('instance')
+        if instance is not None and (instance._state.db == DEFAULT_DB_ALIAS or
+                                     instance._state.db in settings.DATABASE_REPLICAS):
+            # 关联查询使用和instance相同的数据库 (订单分库中的instance关联的商品/用户不在分库中)
+            return instance._state.db
+
+        return get_read_db()
 
     def db_for_write(self, model, **hints):
         """写"""
-        return 'default'
+        if getattr(_local, 'in_request', False):
+            _local.pinned = True
+            _local.written = True
+        return DEFAULT_DB_ALIAS
 
     def allow_relation(self, obj1, obj2, **hints):
         """是否允许关联查询"""
-        return True
\ No newline at end of file
+        return True
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        """只在主库中迁移,从库通过复制同步"""
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinMiddleware(object):
+    """读己之写 : 写过数据的请求(以及POST等修改数据的请求)在响应中设置cookie,之后的请求读主库"""
+
+    def process_request(self, request):
+        _local.in_request = True
+        _local.written = False
+        _local.pinned = PIN_COOKIE in request.COOKIES
+
+    def process_response(self, request, response):
+        if getattr(_local, 'written', False) or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.DATABASE_PIN_SECONDS, httponly=True)
+        _local.in_request = False
+        _local.written = False
+        _local.pinned = False
+        return response
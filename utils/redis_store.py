@@ -0,0 +1,99 @@
+from django.conf import settings
+from django_redis import get_redis_connection
+from django_redis.pool import ConnectionFactory
+from redis.connection import Connection
+from contextlib import contextmanager
+import threading
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# 当前线程(uwsgi的一个请求)的redis统计 : 往返次数,耗费的秒数
+_stats = threading.local()
+
+
+def reset_stats():
+    """请求开始时清零"""
+    _stats.calls = 0
+    _stats.seconds = 0.0
+
+
+def get_stats():
+    """返回 (往返次数, 耗费的秒数)"""
+    return getattr(_stats, 'calls', 0), getattr(_stats, 'seconds', 0.0)
+
+
+class InstrumentedConnection(Connection):
+    """统计往返次数和耗时的redis连接 : 一条命令或者一个pipeline都是一次发送,算一次往返"""
+
+    def send_packed_command(self, command, *args, **kwargs):
+        _stats.calls = getattr(_stats, 'calls', 0) + 1
+        start = time.time()
+        try:
+            return super().send_packed_command(command, *args, **kwargs)
+        finally:
+            _stats.seconds = getattr(_stats, 'seconds', 0.0) + time.time() - start
+
+    def read_response(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            _stats.seconds = getattr(_stats, 'seconds', 0.0) + time.time() - start
+
+
+class InstrumentedConnectionFactory(ConnectionFactory):
+    """django_redis的连接工厂 : 连接池使用InstrumentedConnection
+
+    配置 : DJANGO_REDIS_CONNECTION_FACTORY = 'utils.redis_store.InstrumentedConnectionFactory'
+    """
+
+    def make_connection_params(self, url):
+        params = super().make_connection_params(url)
+        params['connection_class'] = InstrumentedConnection
+        return params
+
+
+class RedisStatsMiddleware(object):
+    """统计每个请求的redis往返次数和耗时
+
+    REDIS_STATS_HEADER为True时,响应头中返回 X-Redis-Calls, X-Redis-Time(毫秒);
+    往返次数超过REDIS_STATS_WARN_CALLS时记录警告日志,用于发现需要合并成pipeline的地方
+    """
+
+    def process_request(self, request):
+        reset_stats()
+
+    def process_response(self, request, response):
+        calls, seconds = get_stats()
+        if settings.REDIS_STATS_HEADER:
+            response['X-Redis-Calls'] = calls
+            response['X-Redis-Time'] = '%.2f' % (seconds * 1000)
+        if calls > settings.REDIS_STATS_WARN_CALLS:
+            logger.warning('redis往返%s次,耗时%.2fms : %s', calls, seconds * 1000, request.path)
+        return response
+
+
+class RedisRepository(object):
+    """redis数据访问的基类 : 子类封装一类数据的key和命令,一个操作中的多条命令合并成一次往返"""
+
+    # django_redis的缓存别名
+    alias = 'default'
+
+    def __init__(self, redis_conn=None):
+        if redis_conn is None:
+            redis_conn = get_redis_connection(self.alias)
+        self.redis_conn = redis_conn
+
+    @contextmanager
+    def pipeline(self, transaction=False):
+        """with self.pipeline() as pipeline: ... 退出时一次发送所有命令,结果保存在pipeline.results"""
+        pipeline = self.redis_conn.pipeline(transaction=transaction)
+        yield pipeline
+        pipeline.results = pipeline.execute()
+
+    def run_script(self, script, keys, args=()):
+        """执行lua脚本 : 脚本已经缓存在redis中时只发送sha1"""
+        return self.redis_conn.register_script(script)(keys=keys, args=list(args))